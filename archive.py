@@ -0,0 +1,109 @@
+"""The archive of a document's intermediate files (LaTeX sources,
+figures, bibliography, UML diagrams), uploaded next to its PDF.
+
+Archives are deterministic: entries are sorted and have a fixed time
+stamp, owner and mode, and links (e.g. into the asset store) are
+followed, so the same files always give the same archive. LaTeX's
+auxiliary files are left out.
+
+Two formats:
+- tgz: a tar file, gzip-compressed at the given level (0-9; 1 is
+  much faster than the default 6, for slightly larger archives)
+- zip: files that are compressed already (PNG, JPEG, PDF) are stored
+  as they are, everything else is deflated
+"""
+
+import os
+import fnmatch
+import gzip
+import tarfile
+import zipfile
+
+
+# never archived: LaTeX's auxiliary files, backups, temporary files
+EXCLUDE = ['*.aux', '*.log', '*.toc', '*.out', '*.lof', '*.lot',
+           '*.blg', '*.idx', '*.ilg', '*.ind', '*.nav', '*.snm',
+           '*.fls', '*.fdb_latexmk', '*.synctex.gz',
+           '*.bak', '*.tmp', '*~']
+
+# stored without compression in zip archives
+COMPRESSED = ('.png', '.jpg', '.jpeg', '.pdf', '.gz', '.tgz', '.zip')
+
+# 1980-01-01, the earliest time a zip file can hold
+ZIPTIME = (1980, 1, 1, 0, 0, 0)
+
+
+def archiveName(docname, fmt):
+    return os.path.join(docname, docname + '-latex.' + fmt)
+
+
+def excluded(filename):
+    return any(fnmatch.fnmatch(filename, p) for p in EXCLUDE)
+
+
+def files(dirs):
+    """sorted (name in the archive, path) of all files below dirs"""
+    result = []
+    for d in dirs:
+        for dirpath, dirnames, filenames in os.walk(d, followlinks=True):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                if not excluded(f) and os.path.isfile(path):
+                    result.append((path, path))
+    return sorted(result)
+
+
+def tarinfo(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = 0
+    info.mode = 0644
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+
+def writeTgz(fp, entries, level):
+    gz = gzip.GzipFile(filename='', mode='wb', fileobj=fp,
+                       compresslevel=level, mtime=0)
+    try:
+        tar = tarfile.open(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT)
+        try:
+            for name, path in entries:
+                with open(path, 'rb') as f:
+                    tar.addfile(tarinfo(name, os.path.getsize(path)), f)
+        finally:
+            tar.close()
+    finally:
+        gz.close()
+
+
+def writeZip(fp, entries):
+    z = zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        for name, path in entries:
+            info = zipfile.ZipInfo(name, ZIPTIME)
+            info.create_system = 3
+            info.external_attr = 0644 << 16
+            if os.path.splitext(name)[1].lower() in COMPRESSED:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as f:
+                z.writestr(info, f.read())
+    finally:
+        z.close()
+
+
+def write(archivefile, entries, fmt='tgz', level=6):
+    """Write the (name, path) entries to archivefile, in format fmt."""
+    if fmt not in ('tgz', 'zip'):
+        raise ValueError("unknown archive format: %s" % fmt)
+    tmp = archivefile + '.%d.tmp' % os.getpid()
+    with open(tmp, 'wb') as fp:
+        if fmt == 'zip':
+            writeZip(fp, entries)
+        else:
+            writeTgz(fp, entries, level)
+    os.rename(tmp, archivefile)
+    print "archived %d files in %s" % (len(entries), archivefile)
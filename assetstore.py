@@ -0,0 +1,82 @@
+"""A content-addressed store for files embedded in wiki pages.
+
+Every file is kept exactly once per machine, under its SHA-1 (the
+same hash the wiki reports in imageinfo). Document directories get
+hardlinks to the stored copy, or symlinks if hardlinks are not
+possible (e.g. the store is on a different filesystem).
+"""
+
+import os
+import shutil
+import hashlib
+
+
+def filehash(path):
+    """SHA-1 of the file at path."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while True:
+            buf = fp.read(64 * 1024)
+            if not buf:
+                break
+            sha1.update(buf)
+    return sha1.hexdigest()
+
+
+def linkfile(src, dest):
+    """Make dest refer to the same content as src: hardlink if
+    possible, else symlink, else copy. An existing dest is removed
+    first, so that we never write through an old link into the store.
+    """
+    src = os.path.realpath(src)
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        try:
+            os.symlink(src, dest)
+        except OSError:
+            shutil.copy(src, dest)
+
+
+class AssetStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, sha1):
+        """Where the file with hash sha1 is (or would be) stored."""
+        return os.path.join(self.directory, sha1[:2], sha1)
+
+    def has(self, sha1):
+        return os.path.isfile(self.path(sha1))
+
+    def staging(self, sha1):
+        """A path to download a file with hash sha1 to,
+        before it is checked and added via add().
+        """
+        d = os.path.join(self.directory, sha1[:2])
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+        return os.path.join(d, '%s.%d.tmp' % (sha1, os.getpid()))
+
+    def add(self, path, sha1):
+        """Move the file at path into the store, if its content
+        really has hash sha1. Returns True on success.
+        """
+        if filehash(path) != sha1:
+            os.unlink(path)
+            return False
+        os.rename(path, self.path(sha1))
+        return True
+
+    def link(self, sha1, dest):
+        """Make dest point to the stored file with hash sha1."""
+        linkfile(self.path(sha1), dest)
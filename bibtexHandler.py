@@ -1,57 +1,162 @@
 """this file encapsulates the bibtex handling routines.
 Only in a separate file because elpy crashed on bibtexparser import :-(
+
+Parsing (with homogeneize_latex_encoding) is slow for large
+bibliographies, so every Bibtex page is parsed on its own and the
+result is cached by the page's content; a document then only merges
+the parsed entries of its pages. So that an @string defined on one
+page can be used on another, the @string definitions of all pages
+are put in front of every page (and are part of its cache key).
 """
 
 import bibtexparser
 import re
 import os
+import glob
 
+import filecache
 
-def processBibtex(docname, bibtex):
-    """process a raw bibtex input as downloaded from wiki.
 
-    Main steps:
-    - remove any wiki anchors
-    - sanitize via bibtex library
-    - write out bibtex file
-    - return a list of bibtex keys, necessary for postprocessing latex
+# wiki anchors, as defined in
+# https://meta.wikimedia.org/wiki/Help:Anchors
+ANCHORS = [re.compile('<( *)div(.*?)>'),
+           re.compile('<( *)/( *)div(.*?)>'),
+           re.compile('<( *)div(.*?) */? *> *')]
 
-    input:
-    - docname: document and subdirectory to be processed
-    - bibtex: string containing the collated files
 
-    output:
-    - list of bibtex keys
-    """
+# \cite{a,b}, \citep[p. 3]{c}, \nocite{*}, ... in LaTeX
+CITE = re.compile(r'\\(?:no)?cite[a-zA-Z]*\*?(?:\[[^\]]*\])*\{([^}]*)\}')
+
+# the start of an entry in a .bib file (as we write them)
+BIBENTRY = re.compile(r'^@\s*(\w+)\s*\{\s*([^,\s]*)', re.M)
+
+CROSSREF = re.compile(r'crossref\s*=\s*[{"]\s*([^}"]*?)\s*[}"]', re.I)
 
-    print "trying to pare bibtex file"
+STRINGSTART = re.compile(r'@\s*string\s*[{(]', re.I)
 
-    # remove any wiki anchors, as defined in
-    # https://meta.wikimedia.org/wiki/Help:Anchors
 
-    bibtex = re.sub('<( *)div(.*?)>', '', bibtex, re.S)
-    bibtex = re.sub('<( *)/( *)div(.*?)>', '', bibtex, re.S)
-    bibtex = re.sub('<( *)div(.*?) */? *> *', '', bibtex)
+def removeAnchors(bibtex):
+    for p in ANCHORS:
+        bibtex = p.sub('', bibtex)
+    return bibtex
 
-    print "bibtex after removing divs, three stages: ", bibtex
 
-    with open(os.path.join(docname, 'tex', 'debug.bib'), 'w') as tmpfh:
-        tmpfh.write(bibtex)
+def stringDefinitions(bibtex):
+    """the @string blocks in bibtex, as text"""
+    blocks = []
+    for m in STRINGSTART.finditer(bibtex):
+        opener = bibtex[m.end() - 1]
+        depth = 0
+        for i in xrange(m.end(), len(bibtex)):
+            c = bibtex[i]
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                if depth == 0 and opener == '{':
+                    break
+                depth -= 1
+            elif c == ')' and depth == 0 and opener == '(':
+                break
+        else:
+            continue
+        blocks.append(bibtex[m.start():i + 1])
+    return blocks
 
-    # sanitize via bibtex library
+
+def parseBibtex(bibtex):
+    """sanitize bibtex via the bibtex library;
+    returns a BibDatabase with lower-cased keys"""
     parser = bibtexparser.bparser.BibTexParser()
     parser.customization = bibtexparser.customization.homogeneize_latex_encoding
-    bibDB = bibtexparser.loads(bibtex,
+    bibDB = bibtexparser.loads(removeAnchors(bibtex),
                                parser=parser)
 
     # lowercase all the bibtex keys, just because that's the way pandoc inserts the refs:
     for e in bibDB.entries:
         e['ID'] = e['ID'].lower()
 
+    return bibDB
+
+
+def parsePage(filename, cache=None, strings=''):
+    """the BibDatabase of one Bibtex page, taken from the
+    FileCache cache if the page has been parsed before;
+    strings are @string definitions to parse in front of it"""
+    with open(filename, 'r') as fh:
+        bibtex = strings + fh.read()
+
+    key = filecache.key(bibtex,
+                        bibtexparser.__version__,
+                        filecache.filehash(__file__.replace('.pyc', '.py')))
+    bibDB = cache.load(key) if cache is not None else None
+    if bibDB is None:
+        print "parsing bibtex page ", filename
+        bibDB = parseBibtex(bibtex)
+        if cache is not None:
+            cache.store(key, bibDB)
+    return bibDB
+
+
+def mergeDatabases(databases):
+    """one BibDatabase with everything in the given ones, in order;
+    of several entries with the same key, only the first is kept"""
+    merged = bibtexparser.bibdatabase.BibDatabase()
+    seen = set()
+    for bibDB in databases:
+        for e in bibDB.entries:
+            if e['ID'] in seen:
+                print "skipping duplicate bibliography entry: ", e['ID']
+                continue
+            seen.add(e['ID'])
+            merged.entries.append(e)
+        merged.comments.extend(bibDB.comments)
+        merged.preambles.extend(bibDB.preambles)
+        merged.strings.update(bibDB.strings)
+    return merged
+
+
+def processBibtex(docname, bibfiles, cache=None, debug=False, outfile=None):
+    """process the raw bibtex pages as downloaded from wiki.
+
+    Main steps:
+    - remove any wiki anchors
+    - sanitize via bibtex library (both per page, see parsePage)
+    - write out bibtex file
+    - return a list of bibtex keys, necessary for postprocessing latex
+
+    input:
+    - docname: document and subdirectory to be processed
+    - bibfiles: the downloaded Bibtex pages
+    - cache: optional FileCache for the parsed pages
+    - debug: also write the collated pages to debug.bib
+    - outfile: the file to write (default: tex/bib.bib)
+
+    output:
+    - list of bibtex keys
+    """
+
+    print "trying to parse %d bibtex pages" % len(bibfiles)
+
+    if debug:
+        with open(os.path.join(docname, 'tex', 'debug.bib'), 'w') as tmpfh:
+            for f in bibfiles:
+                with open(f, 'r') as fh:
+                    tmpfh.write(removeAnchors(fh.read()))
+
+    # the @string definitions of all pages, for every page
+    strings = []
+    for f in bibfiles:
+        with open(f, 'r') as fh:
+            strings.extend(stringDefinitions(removeAnchors(fh.read())))
+    strings = ''.join(s + '\n\n' for s in strings)
+
+    bibDB = mergeDatabases([parsePage(f, cache, strings) for f in bibfiles])
 
     # dump it to file
+    if outfile is None:
+        outfile = os.path.join(docname, 'tex', 'bib.bib')
     writer = bibtexparser.bwriter.BibTexWriter()
-    with open (os.path.join(docname, 'tex', 'bib.bib'),
+    with open (outfile,
                'w') as bh:
         bh.write(writer.write(bibDB))
 
@@ -59,3 +164,55 @@ def processBibtex(docname, bibtex):
     keys = [x['ID'] for x in bibDB.entries]
     print "bibtexkeys (1): ", keys
     return keys
+
+
+def citedKeys(texdir):
+    """the (lower-cased) keys cited by the .tex files in texdir"""
+    keys = set()
+    for f in glob.glob(os.path.join(texdir, '*.tex')):
+        with open(f, 'r') as fh:
+            for m in CITE.finditer(fh.read()):
+                keys.update(k.strip().lower() for k in m.group(1).split(','))
+    keys.discard('')
+    return keys
+
+
+def pruneBibfile(bibfile, cited, outfile=None):
+    """Remove all entries from bibfile whose key is not in cited
+    (or referenced by a crossref of a cited entry); @string,
+    @preamble and @comment blocks are kept. The result is written
+    to outfile, or back to bibfile.
+    Returns the number of entries kept and the total number.
+    """
+    with open(bibfile, 'r') as fh:
+        bibtex = fh.read()
+
+    starts = [m.start() for m in BIBENTRY.finditer(bibtex)]
+    head = bibtex[:starts[0]] if starts else bibtex
+    blocks = [bibtex[a:b] for (a, b) in zip(starts, starts[1:] + [None])]
+
+    entries = []
+    other = []
+    for b in blocks:
+        m = BIBENTRY.match(b)
+        if m.group(1).lower() in ('string', 'preamble', 'comment'):
+            other.append(b)
+        else:
+            entries.append((m.group(2).lower(), b))
+
+    # entries can pull in others via crossref
+    wanted = set(cited)
+    byKey = dict(entries)
+    todo = list(wanted)
+    while todo:
+        b = byKey.get(todo.pop())
+        for ref in CROSSREF.findall(b or ''):
+            if ref.lower() not in wanted:
+                wanted.add(ref.lower())
+                todo.append(ref.lower())
+
+    kept = [b for (k, b) in entries if k in wanted]
+    with open(outfile or bibfile, 'w') as fh:
+        fh.write(head + ''.join(other) + ''.join(kept))
+
+    return len(kept), len(entries)
@@ -11,32 +11,44 @@ import glob
 import re
 import string
 import shutil
-import pickle
 import subprocess
 import pypandoc
 from pprint import pprint as pp
-from collections import defaultdict
 import itertools
 import argparse
-import tarfile
-import hunspell
+import json
+import multiprocessing
+import traceback
+import time
 
 import wikiconnector as wiki
-import path_checksum
-from bibtexHandler import processBibtex
+import filecache
+from filecache import FileCache
+import fingerprint
+from fingerprint import Manifest
+import stages
+from bibtexHandler import processBibtex, citedKeys, pruneBibfile
 
 import wikiBib
+import linkFilter
 
 
 
 import section
+import planner
+import umlrenderer
+import figures
+import archive
+import latexformat
+import latexpost
+import spellcheck
+from buildcontext import BuildContext, BuildError
+from buildstate import BuildState
+from citations import CitationResolver
 
 
 DEFAULT_FIGURE_WIDTH = 0.75  # n\textwidth
 
-# global variables
-bibtexkeys = []     # ugly hack to make this global :-/
-
 
 def ensure_dir(path):
     try:
@@ -58,7 +70,9 @@ def download(target, output, category=None, embedded_elements=True):
 
 def processUML(doc, directory):
     """extract any included UML, put them in the UML dir,
-    write the reduced document back with an input command
+    write the reduced document back with an input command.
+    Returns the list of written .uml files; rendering them
+    is left to the caller (see umlrenderer).
     """
 
     print "UMLing ", doc, " in ", directory
@@ -76,6 +90,7 @@ def processUML(doc, directory):
     with open(filename, 'r') as f:
         data = f.read()
 
+    umlfiles = []
     i = 1
     m = re.search("<uml>(.*?)</uml>", data, re.S)
     while (m):
@@ -102,14 +117,7 @@ def processUML(doc, directory):
             umlhandle.write(umlcontent)
             umlhandle.write("@enduml")
 
-        if True:
-            # trigger the generation of the actual UML figure
-            subprocess.call(['java',
-                             '-jar',
-                             '../../plantuml.jar',
-                             '-teps',
-                             umlfile+'.uml'],
-                             cwd=umldir)
+        umlfiles.append(os.path.join(umldir, umlfile + '.uml'))
 
         data = string.replace(data, m.group(0),
                               "[[File:" + umlfile +
@@ -121,6 +129,8 @@ def processUML(doc, directory):
     with open(filename, 'w') as f:
         f.write(data)
 
+    return umlfiles
+
 
 def processRawFile(doc, directory):
     """Check whether the file qualifies as a raw file.
@@ -147,17 +157,24 @@ def processRawFile(doc, directory):
     return isRawFile
 
 
-def processPandoc(doc, directory):
+def pandocCache():
+    return FileCache(config.PANDOC_CACHE,
+                     maxbytes=config.PANDOC_CACHE_MAXBYTES,
+                     maxage=config.PANDOC_CACHE_MAXAGE)
+
+
+def processPandoc(doc, directory, filterMode='inprocess'):
+    """convert doc in directory to LaTeX. The link filter is run
+    either inside this process on pandoc's JSON AST (filterMode
+    'inprocess') or by pandoc as an external script ('external').
+    """
 
-    def guessFormat(filename):
+    def guessFormat(filename, text):
         """Try to guess whether the file contains
         clean mediawiki syntax or messed-up HTML markup from
         the stupid Rich Editor
         """
 
-        with open (filename, 'r') as f:
-            text = f.read()
-
         htmlCount = len(re.findall("< *h[1-9] *>", text))
         wikiCount = len(re.findall("=+.+=+", text))
 
@@ -187,30 +204,115 @@ def processPandoc(doc, directory):
         os.getcwd(),
         'linkFilter.py'),
          ]
+    extra_args = ['--chapters']
 
-    output = pypandoc.convert(filename,
-                              format=guessFormat(filename),
-                              to='latex',
-                              filters=filters,
-                              extra_args=['--chapters'],
-                              outputfile=outfile)
+    with open(filename, 'r') as f:
+        text = f.read()
+    frmt = guessFormat(filename, text)
+
+    # did we convert exactly this before?
+    cache = pandocCache()
+    key = filecache.key(text, frmt,
+                        *([filecache.filehash(f) for f in filters] +
+                          extra_args +
+                          [fingerprint.toolVersion(['pandoc', '--version'])]))
+    if cache.get(key, outfile):
+        print "pandoc output from cache: ", outfile
+        return
+
+    if filterMode == 'inprocess':
+        ast = json.loads(pypandoc.convert(filename,
+                                          format=frmt,
+                                          to='json'))
+        ast = linkFilter.filterDocument(ast, 'latex')
+        output = pypandoc.convert(json.dumps(ast),
+                                  format='json',
+                                  to='latex',
+                                  extra_args=extra_args,
+                                  outputfile=outfile)
+    else:
+        output = pypandoc.convert(filename,
+                                  format=frmt,
+                                  to='latex',
+                                  filters=filters,
+                                  extra_args=extra_args,
+                                  outputfile=outfile)
     print "padnoc output", output
     assert output == ""
 
+    cache.put(key, outfile)
 
-def processFile(doc, directory, umlFlag, spellcheckFlag, spellCheckDict):
-    """process file doc in directory. Currently defined processing steps:
+
+def processFile(doc, directory, ctx):
+    """process file doc in directory, with the settings of
+    BuildContext ctx. Currently defined processing steps:
     - check whether it is a raw file, then just copy it and do nothing else
-    - extract all included umls and run them thorugh plant uml
+    - extract all included umls (to be run through plant uml by the caller)
     - run pandoc on the remaining file
+
+    Returns the list of extracted .uml files.
     """
 
+    umlfiles = []
     if not processRawFile(doc, directory):
-        if umlFlag:
-            processUML(doc, directory)
-        if spellcheckFlag:
-            processSpellcheck(doc, directory, spellCheckDict)
-        processPandoc(doc, directory)
+        if ctx.umlFlag:
+            umlfiles = processUML(doc, directory)
+        if ctx.spellcheckFlag:
+            processSpellcheck(doc, directory, ctx.spellCheckDict)
+        processPandoc(doc, directory, ctx.filterMode)
+
+    return umlfiles
+
+
+def processFileJob(args):
+    """Run processFile(*args) in a worker process.
+    Returns (result, None), or (None, traceback) if it failed,
+    so that errors can be reported in order by the caller.
+    """
+    try:
+        return processFile(*args), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def processFiles(docs, directory, ctx):
+    """processFile for a list of independent documents,
+    using up to ctx.jobs worker processes.
+    Results and errors are collected in the order of docs.
+
+    Returns the list of all extracted .uml files.
+    """
+
+    jobs = ctx.jobs
+    args = [(doc, directory, ctx) for doc in docs]
+
+    # (worker processes of a pool may not start a pool themselves)
+    if (jobs > 1 and len(docs) > 1 and
+            not multiprocessing.current_process().daemon):
+        print "processing %d files with %d jobs" % (len(docs), jobs)
+        pool = multiprocessing.Pool(min(jobs, len(docs)))
+        try:
+            results = pool.map(processFileJob, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(processFileJob, args)
+
+    umlfiles = []
+    failed = []
+    for doc, (r, e) in zip(docs, results):
+        if e:
+            print "*** ERROR while processing %s ***" % doc
+            print e
+            failed.append(doc)
+        else:
+            umlfiles += r
+
+    if failed:
+        raise Exception("Processing failed for: " + ", ".join(failed))
+
+    return umlfiles
 
 
 def prepareDirectory(docname, filelist, appendixlist,
@@ -228,6 +330,10 @@ def prepareDirectory(docname, filelist, appendixlist,
     shutil.copy('templates/sonata-logo-large.png',
                 os.path.join(docname,
                              'tex'))
+    # our longtable.sty, the same one that is in the LaTeX format
+    shutil.copy('longtable.sty',
+                os.path.join(docname,
+                             'tex'))
 
     # prepare the additional properties:
     print "writing properties"
@@ -277,238 +383,108 @@ def prepareDirectory(docname, filelist, appendixlist,
             appendixfile.write('\\input{' + f + '}\n')
 
 
-def processCiteKeys(doc):
-    """Turn all the autorefs to bibkeys into cites.
-
-    input:
-    - doc is a latex document
-    - global variable: bibtexkeys, contains all the keys found in the bibfiles
-
-    output:
-    - the rewritten doc
-    """
-
-    global bibtexkeys
-
-    # because autoref has the underscores translated to -,
-    # (done by the linkFilter.py filter)
-    # we have to do the same thing here to the bibtexkeys.
-
-    newbibkeys = [re.sub('_', '-', x) for x in bibtexkeys]
-    # print "bibtexkeys: ", newbibkeys
-
-    pattern = 'autoref{(' + '|'.join(newbibkeys) + ')}'
-    doc = re.sub(pattern, 'cite{\\1}', doc)
+def latexpostCache():
+    return FileCache(config.LATEXPOST_CACHE,
+                     maxbytes=config.LATEXPOST_CACHE_MAXBYTES,
+                     maxage=config.LATEXPOST_CACHE_MAXAGE)
 
-    # and now we have to replace them back to the underscore version,
-    # which is the one that is in the bibtex file, probably
-    # (this is far too complicated - need a better way to deal with
-    # the bloody stupid inconstiency of autoref vs label generation)
 
-    deltaKeys = [(x, y)
-                 for (x, y) in zip(bibtexkeys, newbibkeys)
-                 if not x == y]
-    # print "delatakeys: ", deltaKeys
-    for orgkey, wrongkey in deltaKeys:
-        # we need to lower-case the citation key for the bib file
-        # because the references get all lower-cased by linkFilter
-        # (this is becuase the mediawiki reader lower-cases all the
-        # labels for headings, and there is no easy way to distinguish
-        # links to headings from links to references )
-        o = '\\cite{' + orgkey.lower() + '}'
-        w = '\\cite{' + wrongkey + '}'
-
-        doc = doc.replace(w, o)
-
-    return doc
-
-
-def insertFilenameLabel(doc, filename):
-
-    print "inserting: ", filename
-    # get basename, remove extension
-
-    f = os.path.basename(filename)
-    f = os.path.splitext(f)[0]
-    f = re.sub('_', '-', f)
-    f = f.lower()
-
-    tmp = re.sub(
-        "((subsubsection|subsection|section|chapter|paragraph|subparagraph){.*?})",
-        "\\1\\label{" + f + "}", doc,
-        count=1,
-        flags=re.DOTALL)
-
-    return tmp
-
-def preProcessLatex(docdir):
+def preProcessLatex(docdir, citations, keepBackup=False, files=None):
     """Because of limitations in pondoc's mediawiki parser
     and Mediawiki's markup syntax, we need a few tricks
     to get the right LaTeX for figure and table crossreferencing
-    as well as table column styles
+    as well as table column styles (see latexpost.py).
+    citations is the CitationResolver for this document.
+    Only the given files are processed, or all .tex files in docdir.
+    Files whose pandoc output did not change are taken from the cache.
     """
 
-    def replace_tablehead(m):
-        print m
-        print "======"
-        print m.group(1)
-        print "-----"
-        print m.group(2)
-        print "-----"
-        print m.group(3)
-        print "-----"
-        print m.group(4)
-        print "======"
-
-        caption = m.group(2)
-
-        label = m.group(3).lower()
-
-        width = m.group(4)
-        width = re.sub(r'\\{', '{', width)
-        width = re.sub(r'\\}', '}', width)
-
-        # support percentage statements in table column widths:
-        width = re.sub(r'p\s*{\s*([0-9]+)\s*\\%\s*}', 'p{.\\1\\\\textwidth}', width, re.S)
-        print "width: ", width
-        print "======"
-
-        if caption:
-            res = r"\begin{{longtable}}[c]{{{}}} \caption{{{}}}\label{{{}}}\tabularnewline".format(
-                width,
-                caption,
-                label,
-            )
-        else:
-            res = r"\begin{{longtable}}[c]{{{}}}\tabularnewline".format(
-                width,
-            )
-
-
-        print res
-        return res
+    print "preprocessing in ", docdir
 
+    post = latexpost.LatexPostProcessor(citations, DEFAULT_FIGURE_WIDTH)
+    cache = latexpostCache()
+    hits = 0
 
-    print "preprocessing in ", docdir
+    if files is None:
+        files = glob.glob(os.path.join(docdir, '*.tex'))
 
-    for f in glob.glob(os.path.join(docdir, '*.tex')):
+    for f in files:
         if f.endswith('main.tex'):
             continue
-        print "copying ", f
-        shutil.copy(f, f+'.bak')
+        if keepBackup:
+            shutil.copy(f, f+'.bak')
         with open(f, 'r') as fhandle:
             doc = fhandle.read()
 
-        # first, let's see if there is a table head with a caption, and labal, and position marks
-        doc = re.sub(r'\\begin{longtable}\[c\]{(.*?)}\n\\caption{(.*?)\\#(.*?)\\#(.*?)}\\tabularnewline',
-                     # r'\\begin{longtable}[c]{\4}\caption{\2}\label{\3}\tabularnewline',
-                     replace_tablehead,
-                     doc,
-                     flags=re.S)
+        key = filecache.key(doc, os.path.basename(f), post.digest)
+        if cache.get(key, f):
+            hits += 1
+            continue
+
+        doc = post.process(doc, f)
 
-        # allow to manually add horizontal rules to a wiki table by adding {midrule} to the end of the last cell of a row (a not so nice solution, but we need it quick)
-        doc = doc.replace("\\{midrule\\}\\tabularnewline", "\\tabularnewline\\midrule")
+        with open(f, 'w')  as fhandle:
+            fhandle.write(doc)
+        cache.put(key, f)
 
-        # second, lets create labels from the text after a hashmark of a caption:
-        doc = re.sub(r'\\includegraphics{(.*?)}\n\\caption{(.*?)(\\#(.*?))(\\#(.*?))?}',
-                     # r'\caption{\1}\label{\3}',
-                     lambda m: r'\includegraphics[width={3}\textwidth]{{{0}}}\caption{{{1}}}\label{{{2}}}'.format(
-                         m.group(1),
-                         m.group(2),
-                         m.group(4).lower(),
-                         str(DEFAULT_FIGURE_WIDTH) if m.group(5) is None else m.group(5).replace("\#", "")),  # the replace is dirty here, better solution?
-                     doc,
-                     flags=re.S)
+    print "LaTeX post-processing cache hits: ", hits
+    cache.evict()
 
-        # third: there might be undersscorces in labels. right in principle, but
-        # they get escaped by pandoc with an \ . We have to remove the backslash here
-        doc = re.sub(r'\\label{(.*?)}',
-                     lambda m: '\label{' + re.sub(r'\\', '', m.group(1)) + '}',
-                     doc)
 
+def bibtexCache():
+    return FileCache(config.BIBTEX_CACHE,
+                     maxbytes=config.BIBTEX_CACHE_MAXBYTES,
+                     maxage=config.BIBTEX_CACHE_MAXAGE)
 
-        # looks not necessary on account of autoref:
-        # # foruth, turn any \url references into proper refs, unless they point to a true http
-        # doc =  re.sub('\url{(?!http://)(.+?)}', '\\ref{\\1}', doc, flags=re.S)
 
-        # handle cites
-        doc = processCiteKeys(doc)
+def spellcheckCache():
+    return FileCache(config.SPELLCHECK_CACHE,
+                     maxbytes=config.SPELLCHECK_CACHE_MAXBYTES,
+                     maxage=config.SPELLCHECK_CACHE_MAXAGE)
 
-        # insert a label with the file name after the first section
-        doc = insertFilenameLabel(doc, f)
 
-        with open(f, 'w')  as fhandle:
-            fhandle.write(doc)
+def processSpellcheck(doc, directory, spellCheckDict):
+    # do spell check, with the dictionary shared by the whole build
+    session = spellcheck.getSession(spellCheckDict,
+                                    maxwords=config.SPELLCHECK_WORDS)
+    if session is None:
+        return
 
+    session.checkFile(os.path.join(directory, doc) + ".md",
+                      spellcheckCache())
 
-def update_custom_dictionary(hobj, dict_wiki_page_name="Spellchecker_Dict"):
-    """
-    Download custom dictionary from wiki (if available) and add
-    the given words to our local spell checker dictionary.
-    Spell check dictionary location: http://wiki.host.tld/index.php/Spellchecker_Dict
+
+def processLatex(docname, maxPasses=None, fmt=None):
+    """Run pdflatex (and bibtex) until the references have settled.
+
+    - pdflatex passes run in -draftmode until the document has converged;
+      a final pass then produces the PDF
+    - bibtex only runs when the document cites something and the
+      citations or bib.bib changed since its last run
+    - another pass is only done when bibtex has just run, or LaTeX asks
+      for it (rerun warning, undefined references) and main.aux has
+      changed in the last pass, up to maxPasses passes in total
+
+    If fmt is given, pdflatex uses that precompiled preamble format.
+
+    Returns the error of the last pdflatex pass (or None) and a list of
+    (name, value) statistics for the build report.
     """
-    print "Updating custom spell check dictionary using %r" % dict_wiki_page_name
-    # fetch
-    download(dict_wiki_page_name, "/tmp/", None, False)
-    # load
-    with open("/tmp/%s.md" % dict_wiki_page_name, 'r') as f:
-        lines = f.readlines()
-        for l in lines:
-            l = l.strip("\n *-+")
-            if l.isalpha():
-                if not hobj.spell(l):
-                    # word is not in dict, lets add it
-                    hobj.add(l)
-                    print "added %r" % l
-    print "update done."
 
+    if maxPasses is None:
+        maxPasses = config.LATEX_MAX_PASSES
+    texdir = os.path.join(docname, 'tex')
 
-def processSpellcheck(doc, directory, spellCheckDict):
-    # do spell check
-    try:
-        hobj = hunspell.HunSpell('/usr/share/hunspell/%s.dic' % spellCheckDict, '/usr/share/hunspell/%s.aff' % spellCheckDict)
-    except:
-        print "Error: Dictionary %r not found." % spellCheckDict
-        return
-    # check wiki for custom dictionary
-    update_custom_dictionary(hobj) # ugly to call it for each document :-/
-
-    file = os.path.join(directory, doc) + ".md"
-    print "Doing spell check on %r" % file
-    # read md file
-    lines = list()
-    out_lines = list()
-    with open(file, 'r') as f:
-        lines = f.readlines()
-    for line in lines:
-        words = line.strip("\n").split(" ")
-        out_words = list()
-        for w in words:
-            # generate a version of the word that does not contain any non-alpha characters
-            w_striped = w.strip(".:;,!?'_-")
-            if w_striped.isalpha():
-                if not hobj.spell(w_striped):
-                    print "Spelling mistake: %r" % w_striped
-                    # mark mistake! we need to stick to simple ASCII chars, things like <strike> could break the latex document if they occur, e.g., in headings
-                    w = w.replace(w_striped, "??%s??" % w_striped) 
-            out_words.append(w)
-        out_lines.append(" ".join(out_words))
-
-    # write back
-    with open(file, 'w') as f:
-        f.write("\n".join(out_lines))
-
-
-def processLatex(docname):
-
-    def oneRunLatex(docname):
+    def oneRunLatex(docname, draft):
         e = None
         try:
             subprocess.check_output(
                 ['pdflatex',
                  '-shell-escape',
-                 '-interaction=nonstopmode',
-                 'main.tex'],
+                 '-interaction=nonstopmode'] +
+                (['-fmt=' + fmt] if fmt else []) +
+                (['-draftmode'] if draft else []) +
+                ['main.tex'],
                 stderr=subprocess.STDOUT,
                 cwd=os.path.join(docname, 'tex'),
             )
@@ -533,38 +509,143 @@ def processLatex(docname):
 
         return e
 
+    def readTexFile(name):
+        try:
+            with open(os.path.join(texdir, name), 'r') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def auxDigest():
+        aux = readTexFile('main.aux')
+        return filecache.key(aux) if aux is not None else None
+
+    def rerunRequested():
+        log = readTexFile('main.log') or ''
+        return re.search(r'Rerun to get|Label\(s\) may have changed|'
+                         r'There were undefined (references|citations)|'
+                         r'Please rerun LaTeX',
+                         log) is not None
+
+    def bibState():
+        """citations and bibliography as bibtex sees them, or None
+        if the document does not cite anything"""
+        aux = readTexFile('main.aux') or ''
+        citations = set()
+        for c in re.findall(r'\\citation\{(.*?)\}', aux):
+            citations.update(c.split(','))
+        if not citations:
+            return None
+        return filecache.key(','.join(sorted(citations)),
+                             ' '.join(re.findall(r'\\bib(?:data|style)\{.*?\}',
+                                                 aux)),
+                             readTexFile('bib.bib') or '')
 
     e = None
+    passes = 0
+    bibtex = "not needed"
     try:
-        print "latex first pass"
-        e = oneRunLatex(docname)
-        print "bibtex"
-        e = oneRunBibtex(docname)
-        print "latex second pass"
-        e = oneRunLatex(docname)
-        print "latex third pass"
-        e = oneRunLatex(docname)
+        rerun = True
+        while rerun and passes < maxPasses - 1:
+            before = auxDigest()
+            passes += 1
+            print "latex pass %d (draft)" % passes
+            e = oneRunLatex(docname, True)
+            rerun = rerunRequested() and auxDigest() != before
+
+            if passes == 1:
+                state = bibState()
+                if state is None:
+                    # nothing cited (anymore): drop an old bibliography
+                    if os.path.isfile(os.path.join(texdir, 'main.bbl')):
+                        os.unlink(os.path.join(texdir, 'main.bbl'))
+                        rerun = True
+                elif (state == readTexFile('main.bibstate') and
+                      os.path.isfile(os.path.join(texdir, 'main.bbl'))):
+                    bibtex = "unchanged"
+                else:
+                    print "bibtex"
+                    oneRunBibtex(docname)
+                    with open(os.path.join(texdir, 'main.bibstate'),
+                              'w') as f:
+                        f.write(state)
+                    bibtex = "run"
+                    rerun = True
+
+        passes += 1
+        print "latex pass %d (final)" % passes
+        e = oneRunLatex(docname, False)
 
     except Exception as e:
         print e
 
-    return e
+    return e, [('LaTeX passes', passes),
+               ('BibTeX', bibtex),
+               ('Precompiled preamble', 'yes' if fmt else 'no')]
+
+
+# the scripts each stage's output depends on
+SCRIPTS = {
+    'bibliography': ['bibtexHandler.py', 'wikiBib.py'],
+    'chapters': ['build.py', 'linkFilter.py', 'latexpost.py',
+                 'citations.py', 'spellcheck.py'],
+    'prepare': ['build.py', 'latexpost.py', 'citations.py'],
+    'bibtex': ['build.py', 'bibtexHandler.py'],
+    'archive': ['archive.py'],
+    }
 
+# the directories of a document that go into its archive
+ARCHIVE_DIRS = ['tex', 'figures', 'bib', 'uml']
 
 
-def processDocument(docname,
-                    fingerprint,
-                    downloadFlag,
-                    latexFlag,
-                    umlFlag,
-                    embeddedElemetsFlag,
-                    spellcheckFlag):
-    global bibtexkeys
+def scriptsKey(manifest, stage):
+    return filecache.key(*[manifest.filehash(f) for f in SCRIPTS[stage]])
+
+
+def figureProcessor(ctx):
+    """the FigureProcessor for the figures of a document"""
+    return figures.FigureProcessor(
+        figures.maxPixels(config.FIGURE_DPI,
+                          config.FIGURE_TEXTWIDTH,
+                          DEFAULT_FIGURE_WIDTH),
+        cache=FileCache(config.FIGURE_CACHE,
+                        maxbytes=config.FIGURE_CACHE_MAXBYTES,
+                        maxage=config.FIGURE_CACHE_MAXAGE),
+        jobs=config.FIGURE_JOBS or multiprocessing.cpu_count())
+
+
+def writeBibliography(docname, bibfile, cited=None):
+    """Write the bibliography bibfile to the document's bib.bib;
+    if a set of cited keys is given, only with the entries cited by
+    the post-processed LaTeX, so that bibtex does not have to read
+    the whole shared bibliography. (If nothing is cited, bibtex is
+    not run at all, see processLatex.)
+    Returns statistics for the build report.
+    """
+    texbib = os.path.join(docname, 'tex', 'bib.bib')
+    if cited is None or '*' in cited:
+        # (\nocite{*}: everything is wanted)
+        shutil.copy(bibfile, texbib)
+        return []
+    kept, total = pruneBibfile(bibfile, cited, texbib)
+    print "bibliography entries kept: %d of %d" % (kept, total)
+    return [('Bibliography entries', '%d of %d' % (kept, total))]
+
+
+def processDocument(ctx, oldfingerprint):
+    """Build the document described by BuildContext ctx, in stages
+    (see stages.py); oldfingerprint is the stage state of the last build.
+    Returns the error of the LaTeX run (if any), the new stage state
+    and a list of (name, value) statistics for the build report.
+    """
+
+    docname = ctx.docname
+    start = time.time()
 
     print "========================================"
     print "processing document: ", docname
 
-    if downloadFlag:
+    if ctx.downloadFlag:
         # note: we never download embedded elements from control page
         # as this might point to producedd PDF or tar files.
         # we do that in more fine-grained manner below
@@ -578,6 +659,8 @@ def processDocument(docname,
         # later on, might remove all other stuff as well
         # (only clear, when folder already exists)
         # but only when actually downloading things!! not in debug mode!
+        # (unchanged pages are rebuilt from the local page store,
+        # only pages with a new revision are fetched again)
 
         if os.path.exists(os.path.join(docname, 'md')):
             shutil.rmtree(os.path.join(docname, 'md'))
@@ -609,97 +692,155 @@ def processDocument(docname,
 
     properties = section.getProperties(doclines, 'Properties')
 
-    # try to extract property values needed by generator script
-    propSpellCheck = "off"
-    propSpellCheckDict = "en_GB"
-    try:
-        propSpellCheck = dict(properties).get("spellCheck", "off")
-        propSpellCheckDict = dict(properties).get("spellCheckDict", "en_GB")
-    except:
-        pass
-
-    if spellcheckFlag and "on" in propSpellCheck:
-        spellcheckFlag = True
-    else:
-        spellcheckFlag = False
+    # extract property values needed by generator script
+    ctx.setProperties(properties)
 
+    mddir = os.path.join(docname, 'md')
+    texdir = os.path.join(docname, 'tex')
 
     # --------------------------------------------
     # handle abstract, ensure there is always a possibly empty file
 
     section.writeSectionContent(
         doclines, 'Abstract',
-        os.path.join(docname,
-                     'md',
+        os.path.join(mddir,
                      'propertiesAbstract.md'))
 
-    processFile('propertiesAbstract',
-                os.path.join(docname, 'md'),
-                umlFlag,
-                spellcheckFlag, propSpellCheckDict)
-
     # -------------------------------------------
-    # handle bibtex entries
+    # fetch all pages mentioned on the control page in one go
 
-    bibtex = ""
-    # there should always be an even empty bib.bib in tex folder
-    with open(os.path.join(docname,
-                           'tex', "bib.bib"),
-              'w')  as bh:
-        bh.write('% empty bibtex file\n')
-    bibtexkeys = []
-
-    for f in section.downloadSectionFiles(doclines,
-                                          'Bibtex',
-                                          bibdir,
-                                          downloadFlag,
-                                          embeddedElemetsFlag):
-        print "bibtex: ", f
-        with open(os.path.join(bibdir, f+'.md'), 'r') as fh:
-            bibtex += fh.read()
-    bibtexkeys = processBibtex(docname, bibtex)
-
-    for doc in section.downloadSectionFiles(doclines,
-                                            'Wikibib',
-                                            bibdir,
-                                            downloadFlag,
-                                            embeddedElemetsFlag):
-        bibtexkeys += wikiBib.wikibib(infile=os.path.join(bibdir,
-                                                          doc + '.md'),
-                                      outfile=os.path.join(docname,
-                                                           'tex',
-                                                           'bib.bib'))
-
-    print "bibtexkeys (2):", bibtexkeys
+    sectionfiles = section.downloadControlPageFiles(
+        doclines,
+        [('Bibtex', bibdir),
+         ('Wikibib', bibdir),
+         ('TOC', mddir),
+         ('Appendix', mddir)],
+        ctx.downloadFlag,
+        ctx.embeddedElementsFlag)
 
     #--------------------------------------------------
     # process the toc: which files to download, include?
-    mddir = os.path.join(docname, 'md')
-    filelist = section.downloadSectionFiles(doclines,
-                                            'TOC',
-                                            mddir,
-                                            downloadFlag,
-                                            embeddedElemetsFlag)
-    for doc in filelist:
-        print "processing: >>", doc
-        processFile(doc, mddir, umlFlag, spellcheckFlag, propSpellCheckDict)
+    filelist = sectionfiles['TOC']
 
     # similar for possible appendices:
-    appendixlist = section.downloadSectionFiles(doclines,
-                                                'Appendix',
-                                                mddir,
-                                                downloadFlag,
-                                                embeddedElemetsFlag)
-    for doc in appendixlist:
-        print "processing: >>", doc
-        processFile(doc, mddir, umlFlag, spellcheckFlag, propSpellCheckDict)
+    appendixlist = sectionfiles['Appendix']
 
+    # chapters are independent of each other, so process them in parallel
+    # (each page only once, even if it is listed twice)
+    chapters = []
+    for doc in filelist + appendixlist:
+        if doc not in chapters:
+            chapters.append(doc)
 
+    #===========================================
+    # everything from here on is done in stages, each of which is
+    # skipped if its inputs have not changed since the last build
+    manifest = Manifest(os.path.join(docname, 'manifest'))
+    pipeline = stages.Pipeline(manifest, oldfingerprint)
 
+    # -------------------------------------------
+    # handle bibtex entries: collect the document's bibliography
+
+    bibfile = os.path.join(bibdir, 'bibliography.bib')
+
+    def bibliographyStage():
+        bibtexkeys = processBibtex(
+            docname,
+            [os.path.join(bibdir, f+'.md') for f in sectionfiles['Bibtex']],
+            bibtexCache(),
+            config.BIBTEX_DEBUG,
+            bibfile)
+
+        # every key only once, whichever page it comes from
+        seen = set(k.lower() for k in bibtexkeys)
+        for doc in sectionfiles['Wikibib']:
+            bibtexkeys += wikiBib.wikibib(infile=os.path.join(bibdir,
+                                                              doc + '.md'),
+                                          outfile=bibfile,
+                                          seen=seen,
+                                          cache=bibtexCache())
+        bibtexCache().evict()
+        return bibtexkeys, [bibfile]
+
+    ctx.bibtexkeys = pipeline.run(
+        'bibliography',
+        {'pages': manifest.hash(
+            [os.path.join(bibdir, f + '.md')
+             for f in sectionfiles['Bibtex'] + sectionfiles['Wikibib']]),
+         'sources': repr((sectionfiles['Bibtex'], sectionfiles['Wikibib'])),
+         'scripts': scriptsKey(manifest, 'bibliography')},
+        bibliographyStage)
+
+    print "bibtexkeys (2):", ctx.bibtexkeys
+    citations = CitationResolver(ctx.bibtexkeys)
 
+    # -------------------------------------------
+    # convert the abstract and all chapters to post-processed LaTeX
+
+    def sourceFile(doc):
+        return os.path.join(mddir, doc if doc.endswith('.bib') else doc + '.md')
+
+    def texFile(doc):
+        return os.path.join(texdir, doc if doc.endswith('.bib') else doc + '.tex')
+
+    def chaptersStage():
+        umlfiles = processFile('propertiesAbstract', mddir, ctx)
+        print "processing: >>", chapters
+        umlfiles += processFiles(chapters, mddir, ctx)
+
+        pandocCache().evict()
+        if ctx.spellcheckFlag:
+            spellcheckCache().evict()
+
+        texfiles = [texFile(doc) for doc in ['propertiesAbstract'] + chapters]
+        preProcessLatex(texdir, citations, ctx.keepBackup,
+                        [f for f in texfiles if f.endswith('.tex')])
+        return umlfiles, texfiles + umlfiles
+
+    spelling = None
+    if ctx.spellcheckFlag:
+        session = spellcheck.getSession(ctx.spellCheckDict,
+                                        maxwords=config.SPELLCHECK_WORDS)
+        spelling = session.digest if session else None
+
+    umlfiles = pipeline.run(
+        'chapters',
+        {'pages': manifest.hash([sourceFile(doc)
+                                 for doc in ['propertiesAbstract'] + chapters]),
+         'chapters': repr(chapters),
+         'settings': repr((ctx.umlFlag, ctx.spellcheckFlag, ctx.filterMode,
+                           ctx.keepBackup, DEFAULT_FIGURE_WIDTH)),
+         'spelling': spelling,
+         'citations': citations.digest,
+         'pandoc': fingerprint.toolVersion(['pandoc', '--version']),
+         'scripts': scriptsKey(manifest, 'chapters')},
+        chaptersStage)
+
+    # -------------------------------------------
+    # render all the UML diagrams of this document in one go
+
+    processor = figureProcessor(ctx)
+
+    def umlStage():
+        umlrenderer.render(umlfiles,
+                           cache=FileCache(config.UML_CACHE,
+                                           maxbytes=config.UML_CACHE_MAXBYTES,
+                                           maxage=config.UML_CACHE_MAXAGE))
+        # convert the diagrams for pdflatex right away
+        return None, processor.run(
+            [(umlrenderer.outputFile(f), None) for f in umlfiles
+             if os.path.isfile(umlrenderer.outputFile(f))])
+
+    pipeline.run(
+        'uml',
+        {'diagrams': manifest.hash(umlfiles),
+         'plantuml': manifest.filehash(umlrenderer.PLANTUML_JAR),
+         'epstopdf': fingerprint.toolVersion(figures.EPSTOPDF_VERSION)},
+        umlStage)
 
     #=============================================
     # copy figures to figures directory, fix spaces in file name!
+    # (scaled down and converted for pdflatex, see figures.py)
     figextensions = ['png', 'jpg', 'jpeg', 'eps', 'pdf', 'PNG', 'JPG', 'JPEG', 'EPS', 'PDF']
     figurefiles = list(itertools.chain.from_iterable(
         [glob.glob(os.path.join(docname,
@@ -708,36 +849,148 @@ def processDocument(docname,
          for ext in figextensions]))
 
     # just the filenames, not the paths:
-    figurefiles = [os.path.basename(f) for f in figurefiles]
-
-    # and copy the figures to the figures directory,
-    # replace spaces by underscores:
-    for f in figurefiles:
-        shutil.copy(os.path.join(docname, 'md', f),
-                    os.path.join(docname, 'figures', re.sub(' ', '_', f)))
-
-    print figurefiles
+    figurefiles = sorted(os.path.basename(f) for f in figurefiles)
+
+    def figuresStage():
+        # and put the figures into the figures directory,
+        # with spaces replaced by underscores, and as they are:
+        jobs = []
+        for f in figurefiles:
+            names = [re.sub(' ', '_', f)]
+            if f not in names:
+                names.append(f)
+            jobs.append((os.path.join(docname, 'md', f),
+                         [os.path.join(docname, 'figures', n)
+                          for n in names]))
+
+        print figurefiles
+        return None, processor.run(jobs)
+
+    pipeline.run(
+        'figures',
+        {'figures': manifest.hash([os.path.join(mddir, f)
+                                   for f in figurefiles]),
+         'settings': repr((processor.maxwidth, figures.Image is not None)),
+         'epstopdf': fingerprint.toolVersion(figures.EPSTOPDF_VERSION)},
+        figuresStage)
 
     #===========================================
-    # start the actual processing
     # prepare directory
-    prepareDirectory(docname, filelist, appendixlist, properties, doclatex)
 
-    # check against fingerpint
-    newfingerprint = path_checksum.path_checksum(
-        [os.path.join(docname, 'md')])
-    print "fingerprints: ", fingerprint, newfingerprint
+    def prepareStage():
+        prepareDirectory(docname, filelist, appendixlist, properties, doclatex)
+        generated = [os.path.join(texdir, f)
+                     for f in ['moreProperties.tex', 'includer.tex',
+                               'appendixlist.tex']]
+        if doclatex:
+            generated.append(os.path.join(texdir, 'rawtex.tex'))
+        preProcessLatex(texdir, citations, ctx.keepBackup, generated)
+        return None, generated + [
+            os.path.join(texdir, f)
+            for f in ['main.tex', 'documentProperties.tex',
+                      'logo.jpg', 'sonata-logo-large.png',
+                      'longtable.sty']]
+
+    pipeline.run(
+        'prepare',
+        {'properties': repr((properties, doclatex)),
+         'toc': repr((filelist, appendixlist)),
+         'templates': manifest.hash(['templates', 'longtable.sty']),
+         'citations': citations.digest,
+         'scripts': scriptsKey(manifest, 'prepare')},
+        prepareStage)
+
+    # -------------------------------------------
+    # the bib.bib that bibtex gets to see
+
+    cited = None
+    if ctx.pruneBib:
+        cited = citedKeys(texdir)
+
+    report = pipeline.run(
+        'bibtex',
+        {'bibliography': pipeline.key('bibliography'),
+         'cited': repr(sorted(cited)) if cited is not None else None,
+         'scripts': scriptsKey(manifest, 'bibtex')},
+        lambda: (writeBibliography(docname, bibfile, cited),
+                 [os.path.join(texdir, 'bib.bib')]))
+    report = list(report)
+
+    # -------------------------------------------
+    # and finally LaTeX
 
-    # which latexing actions do we have to perform?
     e = None
-    if (not fingerprint == newfingerprint):
-        preProcessLatex(os.path.join(docname, 'tex'))
-        if latexFlag:
-            e = processLatex(docname)
-    else:
+    if ctx.latexFlag:
+        pdffile = os.path.join(texdir, 'main.pdf')
+        # was a PDF written by this run?
+        produced = []
+
+        # the precompiled preamble, if there is one: its name is a
+        # key over the templates it was made from
+        fmt = None
+        if config.LATEX_FORMAT:
+            fmt = latexformat.getFormat(config.LATEX_FORMAT_CACHE)
+
+        def latexStage():
+            before = (os.path.getmtime(pdffile)
+                      if os.path.isfile(pdffile) else None)
+            e, latexReport = processLatex(docname, fmt=fmt)
+            if os.path.isfile(pdffile) and \
+               os.path.getmtime(pdffile) != before:
+                produced.append(pdffile)
+            return (e, latexReport), [pdffile]
+
+        e, latexReport = pipeline.run(
+            'latex',
+            dict([(stage, pipeline.key(stage))
+                  for stage in ['chapters', 'uml', 'figures', 'prepare',
+                                'bibtex']] +
+                 [('tools', filecache.key(
+                     fingerprint.toolVersion(['pdflatex', '--version']),
+                     fingerprint.toolVersion(['bibtex', '--version']))),
+                  ('format', os.path.basename(fmt) if fmt else None)]),
+            latexStage)
+        # pdflatex fails on recoverable errors as well; only if no
+        # PDF came out at all, try again next time
+        if not os.path.isfile(pdffile) or \
+           ('latex' in pipeline.ran and e and not produced):
+            pipeline.forget('latex')
+        if 'latex' in pipeline.ran:
+            report += latexReport
+
+    # -------------------------------------------
+    # the archive of the intermediate files, for the upload;
+    # rebuilt only if one of them has changed
+
+    if ctx.archiveFlag:
+        archivefile = archive.archiveName(docname, config.ARCHIVE_FORMAT)
+        entries = archive.files([os.path.join(docname, d)
+                                 for d in ARCHIVE_DIRS])
+        pipeline.run(
+            'archive',
+            {'files': filecache.key(*[x
+                                      for (name, path) in entries
+                                      for x in (name,
+                                                manifest.filehash(path))]),
+             'settings': repr((config.ARCHIVE_FORMAT, config.ARCHIVE_LEVEL)),
+             'scripts': scriptsKey(manifest, 'archive')},
+            lambda: (archive.write(archivefile, entries,
+                                   config.ARCHIVE_FORMAT,
+                                   config.ARCHIVE_LEVEL),
+                     [archivefile]))
+
+    manifest.save()
+    print "files re-hashed: ", manifest.rehashed
+    if not pipeline.ran:
         print "nothing to be done in ", docname
+    report += [('Build time', '%.0f s' % (time.time() - start)),
+               ('Stages run', ', '.join(pipeline.ran) or 'none'),
+               ('Stages skipped', ', '.join(pipeline.skipped) or 'none'),
+               ('Changed inputs', '; '.join(
+                   '%s: %s' % (stage, ', '.join(changed))
+                   for (stage, changed) in pipeline.changes) or 'none')]
 
-    return e, newfingerprint
+    return e, pipeline.state, report
 
     # report the results back: stdout, pdf file
 
@@ -798,6 +1051,55 @@ def setup_cli_parser():
                         help="Run hunspell and highlight typos in the generated PDF (default: False)"
                         )
 
+    parser.add_argument("--changed-only",
+                        dest="changedOnly",
+                        default=False,
+                        action="store_true",
+                        help="Only process documents that include a page changed on the wiki since the last run (default: False)"
+                        )
+
+    parser.add_argument("--all-documents",
+                        dest="allDocuments",
+                        default=False,
+                        action="store_true",
+                        help="Process all documents, also in a production run (overrides --changed-only)"
+                        )
+
+    parser.add_argument("--jobs",
+                        dest="jobs",
+                        default=1,
+                        type=int,
+                        help="Number of chapters to convert in parallel (default: 1)"
+                        )
+
+    parser.add_argument("--filter-mode",
+                        dest="filterMode",
+                        default="inprocess",
+                        choices=["inprocess", "external"],
+                        help="Run the link filter inside the build process or as an external pandoc filter (default: inprocess)"
+                        )
+
+    parser.add_argument("--parallel-docs",
+                        dest="parallelDocs",
+                        default=1,
+                        type=int,
+                        help="Number of documents to build in parallel; chapters of each document are then converted one after another (default: 1)"
+                        )
+
+    parser.add_argument("--prune-bib",
+                        dest="pruneBib",
+                        action="store_true",
+                        default=False,
+                        help="Only put the cited entries into each document's bib.bib"
+                        )
+
+    parser.add_argument("--keep-bak",
+                        dest="keepBackup",
+                        action="store_true",
+                        default=False,
+                        help="Keep a .bak copy of every tex file before post-processing it"
+                        )
+
     parser.add_argument("-p",
                         dest="production",
                         default=False,
@@ -841,61 +1143,184 @@ def get_documentlist(document, downloadFlag, embeddedElemetsFlag):
     return documentlist
 
 
+def setup_wiki():
+    """connect to the wiki and set up the local stores"""
+    wiki.setup_connection(host=config.WIKIROOT,
+                          user=config.USER,
+                          password=config.PASSWORD)
+    wiki.setup_pagestore(config.PAGESTORE,
+                         BuildState(config.BUILD_STATE))
+    wiki.setup_assetstore(config.ASSETSTORE)
+    wiki.setup_downloader(concurrency=config.DOWNLOAD_CONCURRENCY,
+                          retries=config.DOWNLOAD_RETRIES,
+                          statefile=config.DOWNLOAD_STATE,
+                          cachedir=config.DOWNLOAD_CACHE)
+
+
+def setupDocumentWorker(downloadFlag):
+    """initializer for the --parallel-docs worker processes:
+    give each of them its own wiki connection"""
+    if downloadFlag:
+        setup_wiki()
+
+
+def processDocumentJob(job):
+    """Run processDocument(*job), in a worker process or not.
+    Returns (docname, error, new fingerprint, report, traceback);
+    traceback is None unless the build itself crashed.
+    """
+    ctx, oldfingerprint = job
+    try:
+        e, newfp, report = processDocument(ctx, oldfingerprint)
+        # the page revisions fetched here only live in this process
+        wiki.save_pagestore()
+        return (ctx.docname, BuildError.fromException(e), newfp, report,
+                None)
+    except Exception:
+        return ctx.docname, None, None, [], traceback.format_exc()
+
+
+def localInputsKey():
+    """a key over everything besides the wiki pages that all
+    documents are built from: templates, scripts, tool versions"""
+    files = sorted(glob.glob('templates/*') +
+                   glob.glob(os.path.join(
+                       os.path.dirname(os.path.abspath(__file__)), '*.py')) +
+                   ['longtable.sty', umlrenderer.PLANTUML_JAR])
+    tools = [['pandoc', '--version'],
+             ['pdflatex', '--version'],
+             ['bibtex', '--version'],
+             ['java', '-version'],
+             figures.EPSTOPDF_VERSION]
+    return filecache.key(*([x
+                            for f in files if os.path.isfile(f)
+                            for x in (os.path.basename(f),
+                                      filecache.filehash(f))] +
+                           [fingerprint.toolVersion(t) for t in tools]))
+
+
+def openBuildState():
+    """the build state database, with the fingerprints of
+    older versions imported"""
+    state = BuildState(config.BUILD_STATE)
+    state.importFingerprints('fingerprints')
+    return state
+
+
 def main(args):
 
     # initialize wiki connection
     try:
         if args.download:
-            wiki.setup_connection(host=config.WIKIROOT,
-                                  user=config.USER,
-                                  password=config.PASSWORD)
+            setup_wiki()
     except:
         print "Connection to remote wiki broken. Stopping."
         exit(1)
 
+    # the state of earlier builds:
+    state = openBuildState()
+
+    # which documents are affected by recent changes on the wiki?
+    plan = None
+    changed = None
+    if args.changedOnly and args.download and not args.document:
+        plan = planner.Planner(config.PLANNER_STATE,
+                               inputs=localInputsKey(),
+                               sharedPages=[spellcheck.CUSTOM_DICT_PAGE])
+        if plan.since():
+            changed = wiki.recent_changes(plan.since())
+            print "changed pages: ", changed
+            if not changed and not plan.failed and not plan.inputsChanged:
+                print "nothing changed on the wiki since ", plan.since()
+                plan.save()
+                return
+
+    documentlist = get_documentlist(args.document,
+                                    args.download,
+                                    not args.noEmbeddedElements)
+    if changed is not None:
+        documentlist = plan.affected(documentlist, changed)
+
     # try to get the fingerprints:
-    try:
-        with open('fingerprints', 'r') as fp:
-            fingerprints = pickle.load(fp)
-    except:
-        fingerprints = defaultdict(str)
-
-    # iterate over the documents contained in documentlist:
-    for line in get_documentlist(args.document,
-                                 args.download,
-                                 not args.noEmbeddedElements):
-
-        # if we are to ignore fingerprints, let's just pass in a stupid
-        # value:
-        e, newfp = processDocument(line,
-                                   (fingerprints[line]
-                                    if not args.ignoreFingerprint
-                                    else None),
-                                   args.download,
-                                   args.latex,
-                                   args.uml,
-                                   not args.noEmbeddedElements,
-                                   args.spellcheck)
+    fingerprints = dict((line, state.fingerprint(line))
+                        for line in documentlist)
+
+    # fetch the custom spell check dictionary once for all documents
+    # (before any worker processes are started, they inherit it)
+    if args.spellcheck and args.download:
+        spellcheck.setup()
+
+    # if we are to ignore fingerprints, let's just pass in a stupid
+    # value:
+    jobs = [(BuildContext(line,
+                          downloadFlag=args.download,
+                          latexFlag=args.latex,
+                          umlFlag=args.uml,
+                          embeddedElementsFlag=not args.noEmbeddedElements,
+                          spellcheckFlag=args.spellcheck,
+                          jobs=args.jobs,
+                          filterMode=args.filterMode,
+                          keepBackup=args.keepBackup,
+                          pruneBib=args.pruneBib,
+                          archiveFlag=args.upload),
+             (fingerprints[line]
+              if not args.ignoreFingerprint
+              else None))
+            for line in documentlist]
+
+    def processSerially():
+        # (the same way as in the worker processes, so that a crashing
+        # document does not stop the others)
+        for job in jobs:
+            yield processDocumentJob(job)
+
+    # build whole documents in parallel, each in its own process
+    pool = None
+    if args.parallelDocs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(args.parallelDocs, len(jobs)),
+                                    initializer=setupDocumentWorker,
+                                    initargs=(args.download,))
+        results = pool.imap_unordered(processDocumentJob, jobs)
+    else:
+        results = processSerially()
 
+    # iterate over the documents contained in documentlist,
+    # as they are finished:
+    for line, e, newfp, report, failure in results:
+
+        if failure:
+            print "*** ERROR: building %s failed ***" % line
+            print failure
+            if plan:
+                plan.fail(line)
+            continue
 
         if ((not fingerprints[line] == newfp) or
             (args.ignoreFingerprint)):
             if args.upload:
-                # produce tarfile of the produced latex and figure documents
-                with tarfile.open(os.path.join(line, line+'-latex.tgz'),
-                                  'w:gz') as tar:
-                    tar.add(os.path.join(line, 'tex'))
-                    tar.add(os.path.join(line, 'figures'))
-                    tar.add(os.path.join(line, 'bib'))
-                    tar.add(os.path.join(line, 'uml'))
+                # the archive of the latex and figure files has been
+                # made by processDocument
+                wiki.upload_document(
+                    line, e, report,
+                    archive.archiveName(line, config.ARCHIVE_FORMAT))
+
 
-                wiki.upload_document(line, e)
+        # remember the result right away, for later and concurrent builds
+        state.record(line, newfp, report,
+                     str(getattr(e, 'output', e)) if e else None)
 
+        # remember the page revisions we have seen so far
+        wiki.save_pagestore()
 
-        fingerprints[line] = newfp
+        if plan:
+            plan.record(line)
 
-    with open('fingerprints', 'w') as fp:
-        pickle.dump(fingerprints, fp)
+    if pool:
+        pool.close()
+        pool.join()
+
+    if plan:
+        plan.save()
 
 
 if __name__ == '__main__':
@@ -912,5 +1337,9 @@ if __name__ == '__main__':
         args.uml = True
         args.noEmbeddedElements = False
         args.spellcheck = True
+        args.changedOnly = True
+
+    if args.allDocuments:
+        args.changedOnly = False
 
     main(args)
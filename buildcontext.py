@@ -0,0 +1,70 @@
+"""Per-document build state.
+
+Everything that one document build needs to know or collects on the
+way (command-line switches, control-page properties, bibtex keys)
+lives in a BuildContext instead of module-level globals, so that
+several documents can be built at the same time in separate processes.
+"""
+
+
+class BuildContext(object):
+
+    def __init__(self, docname,
+                 downloadFlag=False,
+                 latexFlag=False,
+                 umlFlag=False,
+                 embeddedElementsFlag=True,
+                 spellcheckFlag=False,
+                 jobs=1,
+                 filterMode='inprocess',
+                 keepBackup=False,
+                 pruneBib=False,
+                 archiveFlag=False):
+
+        self.docname = docname
+
+        # switches for this build
+        self.downloadFlag = downloadFlag
+        self.latexFlag = latexFlag
+        self.umlFlag = umlFlag
+        self.embeddedElementsFlag = embeddedElementsFlag
+        self.spellcheckFlag = spellcheckFlag
+        self.jobs = jobs
+        self.filterMode = filterMode
+        self.keepBackup = keepBackup
+        self.pruneBib = pruneBib
+        self.archiveFlag = archiveFlag
+
+        # taken from the control page
+        self.properties = []
+        self.spellCheckDict = "en_GB"
+
+        # all the keys found in the bib files
+        self.bibtexkeys = []
+
+    def setProperties(self, properties):
+        """Remember the control page's properties and derive the
+        settings used by the generator script from them."""
+        self.properties = properties
+        props = dict(properties)
+        if "on" not in props.get("spellCheck", "off"):
+            self.spellcheckFlag = False
+        self.spellCheckDict = props.get("spellCheckDict", "en_GB")
+
+
+class BuildError(Exception):
+    """A picklable summary of an exception from a document build
+    (CalledProcessError loses its output when sent between processes).
+    """
+
+    def __init__(self, returncode=None, output=None):
+        Exception.__init__(self, returncode, output)
+        self.returncode = returncode
+        self.output = output
+
+    @classmethod
+    def fromException(cls, e):
+        if e is None or isinstance(e, cls):
+            return e
+        return cls(getattr(e, 'returncode', None),
+                   getattr(e, 'output', str(e)))
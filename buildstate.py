@@ -0,0 +1,141 @@
+"""What we know about past builds, in a local SQLite database.
+
+The database holds, per document, the stage state of its last build
+(its fingerprint, see stages.py) together with the build report, the
+cache key and run time of every stage, and the revisions of the wiki
+pages in the page store. It is updated in a transaction as soon as a
+document is finished, so a crash only loses the documents still being
+built. In WAL mode, any number of readers can work next to a writer,
+so parallel and triggered builds can share one database; concurrent
+writers wait for each other (up to TIMEOUT seconds).
+
+A fingerprints file written by older versions is imported once.
+"""
+
+import os
+import time
+import pickle
+import sqlite3
+
+import filecache
+
+
+TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    name TEXT PRIMARY KEY,
+    fingerprint BLOB,
+    report BLOB,
+    error TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    document TEXT,
+    stage TEXT,
+    key TEXT,
+    seconds REAL,
+    updated REAL,
+    PRIMARY KEY (document, stage)
+);
+CREATE TABLE IF NOT EXISTS pages (
+    title TEXT PRIMARY KEY,
+    revid INTEGER,
+    sha1 TEXT
+);
+"""
+
+
+def dumps(obj):
+    return sqlite3.Binary(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def loads(blob):
+    return pickle.loads(str(blob))
+
+
+class BuildState(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=TIMEOUT)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    # ------------------------------------------
+    # documents
+
+    def fingerprint(self, docname):
+        """the stage state of the last build of docname, or ''"""
+        row = self.db.execute(
+            'SELECT fingerprint FROM documents WHERE name = ?',
+            (docname,)).fetchone()
+        if row is None or row[0] is None:
+            return ''
+        return loads(row[0])
+
+    def record(self, docname, fingerprint, report=None, error=None):
+        """Store the result of building docname, all in one transaction."""
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO documents '
+                '(name, fingerprint, report, error, updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (docname, dumps(fingerprint), dumps(report or []),
+                 error, now))
+            if isinstance(fingerprint, dict):
+                for stage, state in fingerprint.items():
+                    if not isinstance(state, dict) or 'inputs' not in state:
+                        continue
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO stages '
+                        '(document, stage, key, seconds, updated) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (docname, stage,
+                         filecache.key(repr(sorted(state['inputs'].items()))),
+                         state.get('seconds'), now))
+
+    def importFingerprints(self, picklefile):
+        """Take over the documents of an old pickled fingerprints
+        file; the file is renamed afterwards."""
+        if not os.path.isfile(picklefile):
+            return
+        try:
+            with open(picklefile, 'rb') as fp:
+                fingerprints = pickle.load(fp)
+        except Exception as e:
+            print "cannot import %s: %s" % (picklefile, e)
+            return
+        print "importing %d fingerprints from %s" % (len(fingerprints),
+                                                     picklefile)
+        with self.db:
+            for docname, fingerprint in fingerprints.items():
+                self.db.execute(
+                    'INSERT OR IGNORE INTO documents '
+                    '(name, fingerprint, updated) VALUES (?, ?, ?)',
+                    (docname, dumps(fingerprint), time.time()))
+        os.rename(picklefile, picklefile + '.imported')
+
+    # ------------------------------------------
+    # page revisions, for the page store
+
+    def pages(self):
+        """title -> (revid, sha1) of all stored pages"""
+        return dict((title, (revid, sha1))
+                    for (title, revid, sha1)
+                    in self.db.execute('SELECT title, revid, sha1 FROM pages'))
+
+    def putPages(self, pages):
+        """store the given title -> (revid, sha1) entries"""
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO pages (title, revid, sha1) '
+                'VALUES (?, ?, ?)',
+                [(title, revid, sha1)
+                 for (title, (revid, sha1)) in pages.items()])
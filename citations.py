@@ -0,0 +1,67 @@
+"""Turn autorefs to bibliography entries into cites.
+
+The linkFilter turns every wiki link into \\autoref{...}, with
+underscores replaced by dashes and everything lower-cased (the
+mediawiki reader lower-cases heading labels, and links to headings
+cannot be told apart from links to references). For links that
+actually point to a bibtex key, we have to produce \\cite{...} with
+the key as it is in the bib file instead. A \\cite{...} that is
+already in the text with the autoref form of a key that contains
+underscores is normalized to that key as well.
+"""
+
+import re
+
+import filecache
+
+
+# autoref{key} (after the backslash) or \cite{key}
+AUTOREF = re.compile(r'(autoref|\\cite)\{([^{}]*)\}')
+
+
+class CitationResolver(object):
+    """Maps the autoref form of every bibtex key to the key to cite.
+    Build it once per document, then call resolve() for every file.
+    """
+
+    def __init__(self, bibtexkeys):
+        self.citekeys = {}
+
+        # keys without underscores are cited as they are ...
+        renamed = {}
+        for key in bibtexkeys:
+            autoref = key.replace('_', '-')
+            if autoref == key:
+                self.citekeys.setdefault(autoref, key)
+            else:
+                # ... the others by their lower-cased original key
+                # (if two keys end up the same, the first one wins)
+                renamed.setdefault(autoref, key.lower())
+        self.citekeys.update(renamed)
+        # cites of the autoref form of a renamed key
+        self.renamed = renamed
+
+        # identifies the mapping, e.g. for caching rewritten files
+        self.digest = filecache.key(*([x
+                                       for item in sorted(self.citekeys.items())
+                                       for x in item] +
+                                      ['renamed'] +
+                                      [x
+                                       for item in sorted(renamed.items())
+                                       for x in item]))
+
+    def _replace(self, m):
+        if m.group(1) == 'autoref':
+            key = self.citekeys.get(m.group(2))
+            cite = 'cite{'
+        else:
+            key = self.renamed.get(m.group(2))
+            cite = '\\cite{'
+        if key is None:
+            return m.group(0)
+        return cite + key + '}'
+
+    def resolve(self, doc):
+        """Rewrite all autorefs to bibtex keys (and cites of their
+        autoref form) in doc, in a single scan."""
+        return AUTOREF.sub(self._replace, doc)
@@ -9,3 +9,87 @@ WIKIROOT="wiki.sonata-nfv.eu"
 
 # Which wiki page contains the list of documents to work on? 
 DOCUMENTLIST="Documentlist"
+
+# Where to keep downloaded wiki pages and their revisions, so that
+# unchanged pages are not fetched again:
+PAGESTORE="pagestore"
+
+# Downloads of embedded files (figures etc.): how many run in parallel,
+# how often a failed download is retried, and where ETags are kept:
+DOWNLOAD_CONCURRENCY=8
+DOWNLOAD_RETRIES=3
+DOWNLOAD_STATE="pagestore/downloads"
+
+# Embedded files that are not kept in the asset store (the wiki did
+# not report a checksum) are cached here, so that later downloads
+# can ask the wiki whether they have changed:
+DOWNLOAD_CACHE="pagestore/files"
+
+# Content-addressed store for embedded files, shared by all documents:
+ASSETSTORE="assetstore"
+
+# SQLite database with the state of past builds (fingerprints,
+# page revisions, stage keys and timings):
+BUILD_STATE="buildstate.db"
+
+# Which wiki pages make up which document, and when we last looked
+# at the wiki's recent changes:
+PLANNER_STATE="planner.state"
+
+# Cache for rendered UML diagrams, evicted by total size (bytes)
+# and age (seconds):
+UML_CACHE="cache/uml"
+UML_CACHE_MAXBYTES=200 * 1024 * 1024
+UML_CACHE_MAXAGE=90 * 24 * 3600
+
+# Raster figures are scaled down to this resolution (dots per inch)
+# at the default figure width, on a text this many inches wide:
+FIGURE_DPI=300
+FIGURE_TEXTWIDTH=6.3
+
+# Cache for scaled figures and EPS files converted to PDF:
+FIGURE_CACHE="cache/figures"
+FIGURE_CACHE_MAXBYTES=1024 * 1024 * 1024
+FIGURE_CACHE_MAXAGE=90 * 24 * 3600
+
+# How many figures to scale or convert at the same time
+# (None: one per CPU; independent of --jobs):
+FIGURE_JOBS=None
+
+# Cache for pandoc's LaTeX output per page:
+PANDOC_CACHE="cache/pandoc"
+PANDOC_CACHE_MAXBYTES=500 * 1024 * 1024
+PANDOC_CACHE_MAXAGE=90 * 24 * 3600
+
+# Cache for the post-processed LaTeX per page:
+LATEXPOST_CACHE="cache/latexpost"
+LATEXPOST_CACHE_MAXBYTES=500 * 1024 * 1024
+LATEXPOST_CACHE_MAXAGE=90 * 24 * 3600
+
+# Spell check results: the checked lines of every page, and at most
+# this many words per dictionary kept in memory:
+SPELLCHECK_CACHE="cache/spellcheck"
+SPELLCHECK_CACHE_MAXBYTES=100 * 1024 * 1024
+SPELLCHECK_CACHE_MAXAGE=90 * 24 * 3600
+SPELLCHECK_WORDS=100000
+
+# Cache for the parsed Bibtex and Wikibib pages; set BIBTEX_DEBUG to also write
+# the collated pages of a document to tex/debug.bib:
+BIBTEX_CACHE="cache/bibtex"
+BIBTEX_CACHE_MAXBYTES=100 * 1024 * 1024
+BIBTEX_CACHE_MAXAGE=90 * 24 * 3600
+BIBTEX_DEBUG=False
+
+# Archive of the intermediate files uploaded with the PDF: "tgz"
+# (gzip at ARCHIVE_LEVEL, 0-9) or "zip" (PNG, JPEG and PDF files are
+# stored as they are, the rest is deflated at zlib's default level):
+ARCHIVE_FORMAT="tgz"
+ARCHIVE_LEVEL=1
+
+# Upper limit for the number of pdflatex passes per document:
+LATEX_MAX_PASSES=5
+
+# Precompile the shared LaTeX preamble of templates/main.tex into a
+# format file (needs the mylatexformat package), cached here:
+LATEX_FORMAT=True
+LATEX_FORMAT_CACHE="cache/latexformat"
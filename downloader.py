@@ -0,0 +1,162 @@
+"""A shared download engine for files embedded in wiki pages.
+
+All downloads go through one requests session, so connections to the
+wiki are kept alive and reused. A fixed number of worker threads
+limits how many downloads run at the same time. Files that already
+exist locally are only transferred again if the server reports a
+change (If-None-Match / If-Modified-Since); failed downloads are
+retried and reported per file.
+
+Files that are not kept in the asset store are downloaded into a
+cache directory (see cachefile()), outside the document directories
+that are cleared before every build, so that these checks can work.
+"""
+
+import os
+import time
+import hashlib
+import calendar
+import threading
+import Queue
+import pickle
+import fcntl
+from email.utils import formatdate, parsedate
+
+import requests
+
+
+class Downloader(object):
+
+    def __init__(self, concurrency=8, retries=3, timeout=60, statefile=None,
+                 cachedir=None):
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.timeout = timeout
+        self.statefile = statefile
+        self.cachedir = cachedir
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # url -> ETag of the version we have locally
+        self.etags = self._load()
+        self.changed = {}
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if not self.statefile:
+            return {}
+        try:
+            with open(self.statefile, 'rb') as fp:
+                return pickle.load(fp)
+        except:
+            return {}
+
+    def save(self):
+        """Merge the ETags learned during this run into the state file."""
+        if not self.statefile or not self.changed:
+            return
+        with open(self.statefile + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            etags = self._load()
+            etags.update(self.changed)
+            tmp = self.statefile + '.%d' % os.getpid()
+            with open(tmp, 'wb') as fp:
+                pickle.dump(etags, fp)
+            os.rename(tmp, self.statefile)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self.changed = {}
+
+    def cachefile(self, url):
+        """Where to keep the download of url between builds,
+        None if there is no cache directory."""
+        if self.cachedir is None:
+            return None
+        if not os.path.isdir(self.cachedir):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                if not os.path.isdir(self.cachedir):
+                    raise
+        ext = os.path.splitext(url.split('?')[0])[1]
+        return os.path.join(self.cachedir,
+                            hashlib.sha1(url).hexdigest() + ext)
+
+    def fetch_one(self, url, dest):
+        """Download url to dest. Returns a tuple (status, error);
+        status is 'downloaded', 'unchanged' or 'failed'.
+        """
+        headers = {}
+        if os.path.isfile(dest):
+            if url in self.etags:
+                headers['If-None-Match'] = self.etags[url]
+            headers['If-Modified-Since'] = formatdate(
+                os.path.getmtime(dest), usegmt=True)
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            try:
+                r = self.session.get(url, headers=headers,
+                                     stream=True, timeout=self.timeout)
+                if r.status_code == 304:
+                    r.close()
+                    return 'unchanged', None
+                if r.status_code == 404:
+                    r.close()
+                    return 'failed', 'HTTP 404'
+                r.raise_for_status()
+
+                tmp = dest + '.%d.part' % os.getpid()
+                with open(tmp, 'wb') as fp:
+                    for chunk in r.iter_content(64 * 1024):
+                        fp.write(chunk)
+                os.rename(tmp, dest)
+
+                modified = r.headers.get('last-modified')
+                if modified and parsedate(modified):
+                    t = calendar.timegm(parsedate(modified))
+                    os.utime(dest, (t, t))
+                etag = r.headers.get('etag')
+                if etag:
+                    with self.lock:
+                        self.etags[url] = etag
+                        self.changed[url] = etag
+                return 'downloaded', None
+            except Exception as e:
+                error = str(e)
+
+        return 'failed', error
+
+    def fetch(self, jobs):
+        """Download a list of (url, dest) jobs with at most
+        concurrency downloads running in parallel.
+        Returns a list of (url, dest, status, error), in job order.
+        """
+        results = [None] * len(jobs)
+        queue = Queue.Queue()
+        for i, job in enumerate(jobs):
+            queue.put((i, job))
+
+        def worker():
+            while True:
+                try:
+                    i, (url, dest) = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                status, error = self.fetch_one(url, dest)
+                results[i] = (url, dest, status, error)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.concurrency, len(jobs)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return results
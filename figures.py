@@ -0,0 +1,169 @@
+"""Prepare figures for pdflatex.
+
+- raster images that are much larger than they can be printed are
+  scaled down to the configured print resolution (this needs PIL;
+  without it, they are used as they are)
+- EPS files are converted to PDF up front, into the file name that
+  pdftex's epstopdf support would use (x-eps-converted-to.pdf). With
+  epstopdf's update option, pdflatex then does not convert them again
+  in every pass.
+
+Both are done in parallel and cached by file content, so a figure is
+only processed again if it (or the settings) changed.
+"""
+
+import os
+from multiprocessing.pool import ThreadPool
+import subprocess
+
+import filecache
+import fingerprint
+from assetstore import filehash, linkfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+RASTER = ('.png', '.jpg', '.jpeg')
+
+EPSTOPDF_VERSION = ['epstopdf', '--version']
+_warnedPIL = False
+
+
+def epsOutput(epsfile):
+    return os.path.splitext(epsfile)[0] + '-eps-converted-to.pdf'
+
+
+def maxPixels(dpi, textwidth, figurewidth):
+    """width in pixels of a figure of figurewidth (fraction of the
+    text width) on a textwidth inch wide text at dpi"""
+    return int(dpi * textwidth * figurewidth)
+
+
+def downscale(src, dest, maxwidth):
+    """Write a copy of the raster image src to dest that is at most
+    maxwidth pixels wide. Returns False if src is small enough (or
+    cannot be read), and nothing was written."""
+    try:
+        img = Image.open(src)
+        width, height = img.size
+        if width <= maxwidth:
+            return False
+        fmt = img.format
+        img = img.resize((maxwidth, max(1, height * maxwidth // width)),
+                         Image.ANTIALIAS)
+        img.save(dest, fmt)
+    except Exception as e:
+        print "*** WARNING: cannot scale %s: %s ***" % (src, e)
+        return False
+    print "scaled %s from %d to %d pixels wide" % (src, width, maxwidth)
+    return True
+
+
+def epstopdf(epsfile, pdffile):
+    try:
+        subprocess.check_output(['epstopdf',
+                                 '--outfile=' + pdffile,
+                                 epsfile],
+                                stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print "*** WARNING: cannot convert %s: %s ***" % (
+            epsfile, getattr(e, 'output', e))
+        return False
+    return True
+
+
+class FigureProcessor(object):
+
+    def __init__(self, maxwidth, cache=None, jobs=1):
+        self.maxwidth = maxwidth
+        self.cache = cache
+        self.jobs = jobs
+
+    def _cached(self, k, dest, make):
+        """dest from the cache under k, or made by make(tmp);
+        returns False if make did not produce anything.
+        (dest is replaced, not written to: it may be a link into
+        the asset store)"""
+        tmp = filecache.tmpname(dest)
+        if self.cache is not None and self.cache.get(k, tmp):
+            os.rename(tmp, dest)
+            return True
+        if not make(tmp):
+            return False
+        os.rename(tmp, dest)
+        if self.cache is not None:
+            self.cache.put(k, dest)
+        return True
+
+    def raster(self, src, dests):
+        """the image src, scaled down if need be, at all of dests"""
+        made = False
+        if Image is not None:
+            k = filecache.key('downscale', filehash(src),
+                              self.maxwidth)
+            made = self._cached(k, dests[0],
+                                lambda tmp: downscale(src, tmp, self.maxwidth))
+        if not made:
+            linkfile(src, dests[0])
+        for d in dests[1:]:
+            linkfile(dests[0], d)
+
+    def eps(self, src, dests=None):
+        """link src to all of dests, and convert it to PDF next to
+        each of them (or next to src itself)"""
+        for d in dests or []:
+            linkfile(src, d)
+        version = fingerprint.toolVersion(EPSTOPDF_VERSION)
+        if version == fingerprint.NOT_AVAILABLE:
+            return
+        k = filecache.key('epstopdf', filehash(src), version)
+        pdffile = epsOutput(dests[0] if dests else src)
+        if self._cached(k, pdffile, lambda tmp: epstopdf(src, tmp)):
+            for d in (dests or [])[1:]:
+                linkfile(pdffile, epsOutput(d))
+
+    def process(self, src, dests):
+        ext = os.path.splitext(src)[1].lower()
+        if ext in RASTER:
+            self.raster(src, dests)
+        elif ext == '.eps':
+            self.eps(src, dests)
+        else:
+            for d in dests:
+                linkfile(src, d)
+
+    def run(self, jobs):
+        """Process all (src, dests) in jobs, in parallel.
+        Returns the list of files written."""
+        global _warnedPIL
+        if Image is None and not _warnedPIL and \
+           any(os.path.splitext(src)[1].lower() in RASTER
+               for src, dests in jobs):
+            print ("*** WARNING: PIL (Pillow) is not installed, "
+                   "figures are not scaled down ***")
+            _warnedPIL = True
+        def one(job):
+            src, dests = job
+            try:
+                self.process(src, dests)
+            except Exception as e:
+                print "*** WARNING: figure %s: %s ***" % (src, e)
+        pool = ThreadPool(max(1, self.jobs))
+        try:
+            pool.map(one, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        if self.cache is not None:
+            self.cache.evict()
+
+        outputs = []
+        for src, dests in jobs:
+            for d in dests or [src]:
+                outputs.append(d)
+                if src.lower().endswith('.eps'):
+                    outputs.append(epsOutput(d))
+        return [f for f in outputs if os.path.isfile(f)]
@@ -0,0 +1,152 @@
+"""A small on-disk cache for build artifacts.
+
+Entries are files named by a key, usually a hash over everything the
+artifact depends on (see key()). A hit copies the stored file into
+place. Entries can be evicted by age and by total size of the cache,
+least recently used first.
+"""
+
+import os
+import time
+import shutil
+import pickle
+import hashlib
+import thread
+
+
+def key(*parts):
+    """Hash the given parts (strings or numbers) into a cache key."""
+    h = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, unicode):
+            p = p.encode('utf8')
+        h.update(str(p))
+        h.update('\0')
+    return h.hexdigest()
+
+
+def tmpname(path):
+    """a temporary name next to path, unique per process and thread"""
+    return path + '.%d.%d.tmp' % (os.getpid(), thread.get_ident())
+
+
+def _discard(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+_filehashes = {}
+
+
+def filehash(path):
+    """SHA-1 of a file (e.g. a tool or filter script),
+    memoized for the lifetime of the process."""
+    path = os.path.abspath(path)
+    if path not in _filehashes:
+        with open(path, 'rb') as fp:
+            _filehashes[path] = hashlib.sha1(fp.read()).hexdigest()
+    return _filehashes[path]
+
+
+class FileCache(object):
+
+    def __init__(self, directory, maxbytes=None, maxage=None):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def path(self, k):
+        return os.path.join(self.directory, k)
+
+    def lookup(self, k):
+        """Path of the entry for k, or None. Marks the entry as used."""
+        p = self.path(k)
+        if not os.path.isfile(p):
+            return None
+        try:
+            os.utime(p, None)
+        except OSError:
+            pass
+        return p
+
+    def get(self, k, dest):
+        """Copy the entry for k to dest. Returns True on a hit."""
+        p = self.lookup(k)
+        if p is None:
+            return False
+        shutil.copyfile(p, dest)
+        return True
+
+    def put(self, k, src):
+        """Store a copy of the file src under k (if that fails,
+        the entry is simply not stored)."""
+        tmp = tmpname(self.path(k))
+        try:
+            shutil.copyfile(src, tmp)
+            os.rename(tmp, self.path(k))
+        except (IOError, OSError) as e:
+            print "cannot store cache entry %s: %s" % (k, e)
+            _discard(tmp)
+
+    def load(self, k):
+        """The object pickled under k, or None."""
+        p = self.lookup(k)
+        if p is None:
+            return None
+        try:
+            with open(p, 'rb') as fp:
+                return pickle.load(fp)
+        except Exception:
+            return None
+
+    def store(self, k, obj):
+        """Pickle obj under k."""
+        tmp = tmpname(self.path(k))
+        try:
+            with open(tmp, 'wb') as fp:
+                pickle.dump(obj, fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path(k))
+        except (IOError, OSError) as e:
+            print "cannot store cache entry %s: %s" % (k, e)
+            _discard(tmp)
+
+    def evict(self):
+        """Remove entries older than maxage (seconds), then the least
+        recently used ones until the cache is below maxbytes."""
+        entries = []
+        for f in os.listdir(self.directory):
+            if f.endswith('.tmp'):
+                continue
+            p = os.path.join(self.directory, f)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+
+        now = time.time()
+        keep = []
+        for mtime, size, p in entries:
+            if self.maxage is not None and now - mtime > self.maxage:
+                self._remove(p)
+            else:
+                keep.append((mtime, size, p))
+
+        if self.maxbytes is not None:
+            total = sum(size for (mtime, size, p) in keep)
+            for mtime, size, p in sorted(keep):
+                if total <= self.maxbytes:
+                    break
+                self._remove(p)
+                total -= size
+
+    def _remove(self, p):
+        _discard(p)
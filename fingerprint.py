@@ -0,0 +1,99 @@
+"""Fingerprints of everything a document build depends on.
+
+A fingerprint is a dictionary mapping the name of an input (e.g.
+'md', 'templates', 'tools') to a hash over it; comparing it with the
+one of the last build tells which inputs have changed (see changed()).
+
+File contents are hashed with the help of a Manifest, which remembers
+size, modification time and hash of every file it has seen: a file
+is only read again if its size or modification time has changed.
+"""
+
+import os
+import pickle
+import hashlib
+import subprocess
+
+import filecache
+
+
+# toolVersion() of a tool that cannot be run
+NOT_AVAILABLE = 'not available'
+
+_toolVersions = {}
+
+
+def toolVersion(cmd):
+    """first line of the output of cmd (e.g. ['pandoc', '--version']),
+    asked only once per process"""
+    cmd = tuple(cmd)
+    if cmd not in _toolVersions:
+        try:
+            _toolVersions[cmd] = subprocess.check_output(
+                cmd, stderr=subprocess.STDOUT).split('\n')[0]
+        except (OSError, subprocess.CalledProcessError):
+            _toolVersions[cmd] = NOT_AVAILABLE
+    return _toolVersions[cmd]
+
+
+class Manifest(object):
+
+    def __init__(self, statefile):
+        self.statefile = statefile
+
+        # path -> (size, mtime, sha1)
+        try:
+            with open(statefile, 'rb') as fp:
+                self.entries = pickle.load(fp)
+        except:
+            self.entries = {}
+        # the entries used in this run, the others are dropped on save
+        self.used = {}
+        self.rehashed = 0
+
+    def filehash(self, path):
+        """SHA-1 of the file path, read only if it has changed"""
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is None or entry[:2] != (st.st_size, st.st_mtime):
+            h = hashlib.sha1()
+            with open(path, 'rb') as fp:
+                for buf in iter(lambda: fp.read(1024 * 1024), ''):
+                    h.update(buf)
+            entry = (st.st_size, st.st_mtime, h.hexdigest())
+            self.rehashed += 1
+        self.entries[path] = entry
+        self.used[path] = entry
+        return entry[2]
+
+    def hash(self, paths):
+        """one hash over the names and contents of all files in paths
+        (files or directories, searched recursively); paths that do
+        not exist are left out"""
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    files.extend(os.path.join(dirpath, f)
+                                 for f in sorted(filenames))
+            elif os.path.isfile(path):
+                files.append(path)
+        return filecache.key(*[x
+                               for f in files
+                               for x in (f, self.filehash(f))])
+
+    def save(self):
+        tmp = self.statefile + '.%d' % os.getpid()
+        with open(tmp, 'wb') as fp:
+            pickle.dump(self.used, fp)
+        os.rename(tmp, self.statefile)
+
+
+def changed(old, new):
+    """the names of the inputs that differ between the fingerprints
+    old and new (all of them, if old is not a fingerprint at all)"""
+    if not isinstance(old, dict):
+        return sorted(new)
+    return sorted(k for k in set(old) | set(new)
+                  if old.get(k) != new.get(k))
@@ -0,0 +1,82 @@
+"""Precompiled LaTeX format for the shared preamble of templates/main.tex.
+
+Loading the preamble (KOMA script, hyperref, tikz, ...) is a large part
+of every pdflatex pass. Using the mylatexformat package, everything up
+to the \\endofdump marker in main.tex is dumped into a format file once.
+The format is cached under a key made of the template files and the
+pdflatex version, so all documents built from the same templates share
+it. The per-document parts (moreProperties.tex, rawtex.tex) come after
+the marker and are still read on every pass.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+import filecache
+import fingerprint
+
+
+# the files that end up in the dumped part of the preamble
+TEMPLATES = ['templates/main.tex',
+             'templates/documentProperties.tex',
+             'longtable.sty']
+
+_failed = False
+
+
+def dump(fmtfile):
+    """Dump the preamble of the templates into fmtfile.
+    Returns True on success."""
+    tmpdir = tempfile.mkdtemp(prefix='latexformat')
+    try:
+        for f in TEMPLATES:
+            shutil.copy(f, tmpdir)
+        try:
+            subprocess.check_output(
+                ['pdflatex',
+                 '-ini',
+                 '-interaction=nonstopmode',
+                 '-jobname=preamble',
+                 '&pdflatex',
+                 'mylatexformat.ltx',
+                 'main.tex'],
+                stderr=subprocess.STDOUT,
+                cwd=tmpdir)
+        except subprocess.CalledProcessError as e:
+            print "dumping the LaTeX format failed: ", e, e.output
+            return False
+        shutil.move(os.path.join(tmpdir, 'preamble.fmt'), fmtfile)
+        return True
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def getFormat(cachedir):
+    """Path (without .fmt suffix, as pdflatex -fmt wants it) of the
+    format for the current templates, dumping it if necessary.
+    Returns None if no format can be made; the caller should then
+    run pdflatex without one.
+    """
+    global _failed
+    if _failed:
+        return None
+
+    try:
+        key = filecache.key(fingerprint.toolVersion(['pdflatex', '--version']),
+                            *[filecache.filehash(f) for f in TEMPLATES])
+        cache = filecache.FileCache(cachedir)
+        fmt = cache.path(key)
+        if cache.lookup(key + '.fmt') is None:
+            print "dumping LaTeX format for the preamble"
+            if not dump(fmt + '.fmt.%d.tmp' % os.getpid()):
+                _failed = True
+                return None
+            os.rename(fmt + '.fmt.%d.tmp' % os.getpid(), fmt + '.fmt')
+    except Exception as e:
+        print "no LaTeX format available: ", e
+        _failed = True
+        return None
+
+    return os.path.abspath(fmt)
@@ -0,0 +1,126 @@
+"""Post-process the LaTeX produced by pandoc.
+
+Because of limitations in pandoc's mediawiki parser and Mediawiki's
+markup syntax, a few rewrites are needed to get the right LaTeX for
+figure and table cross-referencing, table column styles and cites:
+
+1. table heads with a caption of the form "caption#label#columns"
+2. {midrule} markers at the end of a table row
+3. figure captions of the form "caption#label[#width]"
+4. escaped underscores in labels
+5. autorefs to bibtex keys, and cites of their autoref form
+   (see citations.py)
+
+The rules are compiled once and applied one after another, in this
+order: the table rules have to come first, as a figure caption
+searched for lazily could otherwise run on into a table caption.
+Finally, a label with the file name is added to the first heading.
+"""
+
+import os
+import re
+
+import filecache
+
+
+TABLEHEAD = (r'\\begin\{longtable\}\[c\]\{(?P<t_spec>.*?)\}\n'
+             r'\\caption\{(?P<t_caption>.*?)\\#(?P<t_label>.*?)'
+             r'\\#(?P<t_width>.*?)\}\\tabularnewline')
+
+# allow to manually add horizontal rules to a wiki table by adding
+# {midrule} to the end of the last cell of a row
+MIDRULE = r'\\\{midrule\\\}\\tabularnewline'
+
+FIGURE = (r'\\includegraphics\{(?P<f_file>.*?)\}\n'
+          r'\\caption\{(?P<f_caption>.*?)\\#(?P<f_label>.*?)'
+          r'(?P<f_width>\\#.*?)?\}')
+
+# (labels never span lines)
+LABEL = r'\\label\{(?P<l_label>[^\n]*?)\}'
+
+AUTOREF = r'(?:autoref|\\cite)\{[^{}]*\}'
+
+# support percentage statements in table column widths
+PERCENTWIDTH = re.compile(r'p\s*{\s*([0-9]+)\s*\\%\s*}')
+
+SECTION = re.compile(
+    "((subsubsection|subsection|section|chapter|paragraph|subparagraph){.*?})",
+    re.S)
+
+
+def fileLabel(filename):
+    """the label for a file: basename without extension,
+    underscores as dashes, lower case"""
+    f = os.path.basename(filename)
+    f = os.path.splitext(f)[0]
+    return f.replace('_', '-').lower()
+
+
+def insertFilenameLabel(doc, filename):
+    """insert a label with the file name after the first heading"""
+    return SECTION.sub(lambda m: m.group(1) + "\\label{" +
+                       fileLabel(filename) + "}",
+                       doc, count=1)
+
+
+class LatexPostProcessor(object):
+
+    def __init__(self, citations, figureWidth):
+        self.citations = citations
+        self.figureWidth = figureWidth
+
+        self.rules = [('table', TABLEHEAD, self.tablehead),
+                      ('midrule', MIDRULE, self.midrule),
+                      ('figure', FIGURE, self.figure),
+                      ('label', LABEL, self.label),
+                      ('cite', AUTOREF, self.cite)]
+        self.compiled = [(re.compile(p, re.S), h)
+                         for (name, p, h) in self.rules]
+
+        # everything the output depends on, besides the input itself
+        self.digest = filecache.key(citations.digest,
+                                    figureWidth,
+                                    filecache.filehash(
+                                        __file__.replace('.pyc', '.py')))
+
+    def tablehead(self, m):
+        caption = m.group('t_caption')
+        label = m.group('t_label').lower()
+
+        width = m.group('t_width')
+        width = width.replace('\\{', '{').replace('\\}', '}')
+        width = PERCENTWIDTH.sub(r'p{.\1\\textwidth}', width)
+
+        if caption:
+            return r"\begin{{longtable}}[c]{{{}}} \caption{{{}}}\label{{{}}}\tabularnewline".format(
+                width,
+                caption,
+                label,
+            )
+        else:
+            return r"\begin{{longtable}}[c]{{{}}}\tabularnewline".format(
+                width,
+            )
+
+    def midrule(self, m):
+        return "\\tabularnewline\\midrule"
+
+    def figure(self, m):
+        return r'\includegraphics[width={3}\textwidth]{{{0}}}\caption{{{1}}}\label{{{2}}}'.format(
+            m.group('f_file'),
+            m.group('f_caption'),
+            m.group('f_label').lower(),
+            (str(self.figureWidth) if m.group('f_width') is None
+             else m.group('f_width').replace("\\#", "")))
+
+    def label(self, m):
+        # underscores in labels get escaped by pandoc with a backslash
+        return '\\label{' + m.group('l_label').replace('\\', '') + '}'
+
+    def cite(self, m):
+        return self.citations.resolve(m.group(0))
+
+    def process(self, doc, filename):
+        for rule, handler in self.compiled:
+            doc = rule.sub(handler, doc)
+        return insertFilenameLabel(doc, filename)
@@ -5,14 +5,28 @@
 """
 Pandoc filter to convert links from mediawiki in a more
 useful format.
+
+Can be run by pandoc as an external filter, or in process on a
+parsed pandoc JSON document via filterDocument().
+Set LINKFILTER_DEBUG=1 in the environment to get a dump of every
+handled node on stderr.
 """
+import os
 import sys
-from pandocfilters import toJSONFilter, Link, Str, RawInline
+from pandocfilters import toJSONFilter, walk, Link, Str, RawInline
+
+
+DEBUG = bool(os.environ.get('LINKFILTER_DEBUG'))
+
+
+def debug(msg):
+    if DEBUG:
+        sys.stderr.write(msg)
 
 
 def linkhandler(key, value, frmt, meta):
     if key == 'Link':
-        sys.stderr.write(
+        debug(
             'Key: {} Type of Key: {} \nValue: {}\nfrmt: {} \nmeta: {}\n-------\n'
             .format(
                 key, type(key),
@@ -41,12 +55,12 @@ def linkhandler(key, value, frmt, meta):
                 if "#" in link:
                     link = link.split('#')[1]
 
-                sys.stderr.write("link: {}\n---\n\n".format(link))
+                debug("link: {}\n---\n\n".format(link))
                 link = '-'.join([x.lower() for x in link.split('_')])
                 return RawInline('latex', "\\autoref{{{}}}".format(link))
 
     elif key == 'RawInline': 
-        sys.stderr.write(
+        debug(
             'Key: {} Type of Key: {} \nValue: {}\nfrmt: {} \nmeta: {}\n-------\n'
             .format(
                 key, type(key),
@@ -60,5 +74,17 @@ def linkhandler(key, value, frmt, meta):
                 if val == '<newpage>':
                     return RawInline('latex', '\\newpage')
 
+def filterDocument(doc, frmt='latex'):
+    """Apply linkhandler to a pandoc JSON document (as parsed by
+    json.loads), like pandoc would do with this script as a filter.
+    """
+    if isinstance(doc, dict):
+        # pandoc >= 1.18
+        meta = doc.get('meta', {})
+    else:
+        meta = doc[0]['unMeta']
+    return walk(doc, linkhandler, frmt, meta)
+
+
 if __name__ == "__main__":
     toJSONFilter(linkhandler)
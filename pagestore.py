@@ -0,0 +1,104 @@
+"""A local store for downloaded wiki pages.
+
+For every page, the store remembers the revision ID it was fetched
+at and the SHA-1 of its content; the content itself is kept in a
+file named after that hash. A later download then only has to fetch
+the text of pages whose revision has changed.
+
+The index is kept in a pickle file next to the pages, or in the
+build state database (see buildstate.py) if one is given; an existing
+index file is then imported into the database.
+"""
+
+import os
+import hashlib
+import pickle
+import fcntl
+
+
+class PageStore(object):
+
+    def __init__(self, directory, state=None):
+        self.directory = directory
+        self.state = state
+        self.pagedir = os.path.join(directory, 'pages')
+        self.indexfile = os.path.join(directory, 'index')
+        if not os.path.isdir(self.pagedir):
+            os.makedirs(self.pagedir)
+
+        # title -> (revid, sha1)
+        self.index = self._load()
+        # entries added during this run, merged into the index on save
+        self.changed = {}
+
+    def _load(self):
+        if self.state is not None:
+            index = self.state.pages()
+            if not index and os.path.isfile(self.indexfile):
+                index = self._loadfile()
+                self.state.putPages(index)
+            return index
+        return self._loadfile()
+
+    def _loadfile(self):
+        try:
+            with open(self.indexfile, 'rb') as fp:
+                return pickle.load(fp)
+        except:
+            return {}
+
+    def _contentfile(self, sha1):
+        return os.path.join(self.pagedir, sha1 + '.md')
+
+    def lookup(self, title, revid):
+        """Return the content hash of title if the stored copy
+        is at revision revid, None otherwise.
+        """
+        entry = self.index.get(title)
+        if entry and entry[0] == revid and \
+           os.path.isfile(self._contentfile(entry[1])):
+            return entry[1]
+        return None
+
+    def get(self, title):
+        """Return the stored (utf8 encoded) text of title."""
+        revid, sha1 = self.index[title]
+        with open(self._contentfile(sha1), 'rb') as fp:
+            return fp.read()
+
+    def put(self, title, revid, text):
+        """Store text (utf8 encoded) of title at revision revid."""
+        sha1 = hashlib.sha1(text).hexdigest()
+        contentfile = self._contentfile(sha1)
+        if not os.path.isfile(contentfile):
+            tmp = contentfile + '.%d' % os.getpid()
+            with open(tmp, 'wb') as fp:
+                fp.write(text)
+            os.rename(tmp, contentfile)
+        self.index[title] = (revid, sha1)
+        self.changed[title] = (revid, sha1)
+        return sha1
+
+    def save(self):
+        """Merge our changes into the index file on disk.
+        The file is locked while doing so, so that concurrent
+        builds do not lose each other's entries.
+        """
+        if not self.changed:
+            return
+        if self.state is not None:
+            self.state.putPages(self.changed)
+            self.index.update(self.changed)
+            self.changed = {}
+            return
+        with open(self.indexfile + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._load()
+            index.update(self.changed)
+            tmp = self.indexfile + '.%d' % os.getpid()
+            with open(tmp, 'wb') as fp:
+                pickle.dump(index, fp)
+            os.rename(tmp, self.indexfile)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self.index = index
+        self.changed = {}
@@ -0,0 +1,145 @@
+"""Decide which documents need a rebuild, based on the wiki's recent changes.
+
+The planner keeps a reverse index from wiki page to the documents
+that include it: the control page itself, the pages listed in its
+TOC, Appendix, Bibtex and Wikibib sections, and the files embedded
+in them. After a run, it remembers when that run started; the next
+run asks the wiki which pages were edited since then and only builds
+the documents that include one of them. Documents whose build crashed
+are remembered as failed and built again in the next run, whatever
+has changed.
+
+Every document is rebuilt if one of the pages all documents depend on
+(e.g. the custom spell check dictionary) has changed, or the local
+inputs of the build (templates, scripts, tool versions; given as one
+key) differ from those of the last run.
+"""
+
+import os
+import time
+import pickle
+import fcntl
+
+import section
+
+
+# how far to look back before the last run's start, to cover clock skew
+OVERLAP = 300
+
+
+def normalize(title):
+    """Bring a page name into the form the wiki reports it in."""
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+def timestamp(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+def documentPages(docname):
+    """All wiki pages (and files) that the given document is built from,
+    according to its local copy.
+    """
+    pages = set([normalize(docname)])
+
+    try:
+        with open(os.path.join(docname, docname + '.md'), 'r') as f:
+            doclines = f.read()
+    except IOError:
+        return pages
+
+    for s in ['TOC', 'Appendix', 'Bibtex', 'Wikibib']:
+        pages.update(normalize(p) for p in section.getBullets(doclines, s))
+
+    # embedded files are stored under their name without "File:"
+    for d in ['md', 'bib']:
+        try:
+            files = os.listdir(os.path.join(docname, d))
+        except OSError:
+            continue
+        pages.update('File:' + normalize(f)
+                     for f in files
+                     if not f.endswith('.md'))
+
+    return pages
+
+
+class Planner(object):
+
+    def __init__(self, statefile, inputs=None, sharedPages=()):
+        self.statefile = statefile
+        self.started = time.time()
+        state = self._load()
+        self.lastrun = state['lastrun']
+        # a key over the local inputs of the build
+        self.inputs = inputs
+        self.inputsChanged = (inputs is not None and
+                              inputs != state.get('inputs'))
+        self.sharedPages = set(normalize(p) for p in sharedPages)
+        # document -> set of pages
+        self.documents = state['documents']
+        # documents whose last build crashed
+        self.failed = state.get('failed', set())
+        self.recorded = {}
+        self.crashed = set()
+
+    def _load(self):
+        try:
+            with open(self.statefile, 'rb') as fp:
+                return pickle.load(fp)
+        except:
+            return {'lastrun': None, 'documents': {}}
+
+    def since(self):
+        """Timestamp from which on to ask for recent changes,
+        None if we have never run before.
+        """
+        if self.lastrun is None:
+            return None
+        return timestamp(self.lastrun - OVERLAP)
+
+    def affected(self, documentlist, changed):
+        """Filter documentlist down to the documents that include
+        a changed page, that we have never built before or whose
+        last build crashed.
+        """
+        changed = set(normalize(c) for c in changed)
+        if self.inputsChanged or changed & self.sharedPages:
+            print "local inputs or shared pages changed, all documents affected"
+            return list(documentlist)
+        r = [d for d in documentlist
+             if d not in self.documents or
+             d in self.failed or
+             self.documents[d] & changed]
+        print "affected documents: ", r
+        return r
+
+    def record(self, docname):
+        """Remember which pages docname has been built from."""
+        self.documents[docname] = documentPages(docname)
+        self.recorded[docname] = self.documents[docname]
+        self.crashed.discard(docname)
+
+    def fail(self, docname):
+        """Remember that building docname crashed, so that the
+        next run tries again."""
+        self.crashed.add(docname)
+        self.recorded.pop(docname, None)
+
+    def save(self):
+        """Store the index and the start time of this run."""
+        with open(self.statefile + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._load()
+            state['documents'].update(self.recorded)
+            state['failed'] = ((state.get('failed', set()) | self.crashed) -
+                               set(self.recorded))
+            if self.inputs is not None:
+                state['inputs'] = self.inputs
+            state['lastrun'] = self.started
+            tmp = self.statefile + '.%d' % os.getpid()
+            with open(tmp, 'wb') as fp:
+                pickle.dump(state, fp)
+            os.rename(tmp, self.statefile)
+            fcntl.flock(lock, fcntl.LOCK_UN)
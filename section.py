@@ -4,6 +4,7 @@
 
 import os
 import re
+import traceback
 import wikiconnector
 
 
@@ -84,6 +85,11 @@ def downloadSectionFiles(text, section, dirname, downloadFlag, embeddedElemetsFl
     return list of successfull file names
     """
 
+    if downloadFlag:
+        return downloadControlPageFiles(text, [(section, dirname)],
+                                        downloadFlag,
+                                        embeddedElemetsFlag)[section]
+
     filenames = linesFromBulletlist(
         getSectionLines(text, section))
 
@@ -92,30 +98,65 @@ def downloadSectionFiles(text, section, dirname, downloadFlag, embeddedElemetsFl
 
     for f in filenames:
         tmp = f.strip()
-        print "trying to download: ", tmp, '\n'
         if tmp:
-            if downloadFlag:
-                try:
-                    wikiconnector.download(
-                        target=tmp,
-                        output=dirname,
-                        embedded_elements=embeddedElemetsFlag)
-
-                    r.append(f)
-                except:
-                    pass
-            else:
-                # no download, but does the file already exist locally?
-                fname = os.path.join(dirname, tmp + '.md')
-                print "tmp: >>>", tmp, "<<<", dirname, fname
-
-                try:
-                    fp = open(fname, 'r')
-                    r.append(tmp)
-                    fp.close()
-                except:
-                    pass
+            # no download, but does the file already exist locally?
+            fname = os.path.join(dirname, tmp + '.md')
+            print "tmp: >>>", tmp, "<<<", dirname, fname
+
+            try:
+                fp = open(fname, 'r')
+                r.append(tmp)
+                fp.close()
+            except:
+                pass
+
+    print "reutrning: ", r
+    return r
+
+
+def downloadControlPageFiles(text, sections, downloadFlag, embeddedElemetsFlag):
+    """like downloadSectionFiles, but for several sections at once.
+    sections is a list of (section, dirname) tuples. When downloading,
+    all pages of all sections are fetched in one bulk request.
+    return a dictionary mapping section to list of successful file names
+    """
 
+    if not downloadFlag:
+        return dict((s, downloadSectionFiles(text, s, d,
+                                             downloadFlag,
+                                             embeddedElemetsFlag))
+                    for (s, d) in sections)
+
+    filenames = dict((s, [f.strip()
+                          for f in linesFromBulletlist(
+                              getSectionLines(text, s))
+                          if f.strip()])
+                     for (s, d) in sections)
+
+    targets = [(f, d)
+               for (s, d) in sections
+               for f in filenames[s]]
+    print "bulk download: ", targets
+
+    try:
+        fetched = wikiconnector.download_pages(
+            targets,
+            embedded_elements=embeddedElemetsFlag)
+    except Exception:
+        print "*** WARNING: bulk download failed, fetching page by page ***"
+        traceback.print_exc()
+        fetched = []
+        for target in targets:
+            try:
+                fetched.extend(wikiconnector.download_pages(
+                    [target],
+                    embedded_elements=embeddedElemetsFlag))
+            except Exception as e:
+                print "*** WARNING: cannot download %s: %s ***" % (
+                    target[0], e)
+
+    r = dict((s, [f for f in filenames[s] if f in fetched])
+             for (s, d) in sections)
     print "reutrning: ", r
     return r
 
@@ -0,0 +1,245 @@
+"""Spell checking with hunspell, shared by all chapters of a build.
+
+Loading a hunspell dictionary and adding the words of the custom
+dictionary page from the wiki is expensive, so both happen only once:
+
+- the custom dictionary page is fetched once per build (through the
+  page store, so its text is only downloaded again when it has a new
+  revision); call setup() in the main process before starting worker
+  processes, they inherit the words
+- each hunspell dictionary is loaded once per process and then
+  shared by all chapters of all documents built in that process
+
+A Session remembers the result for the most recently checked words,
+and only checks prose: wikitext markup, code and <uml> blocks, URLs,
+file links and table syntax are left alone. With a FileCache, the
+checked lines of every page are kept, so that the next check of the
+page only has to look at the lines that have changed.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import hunspell
+
+import wikiconnector as wiki
+import filecache
+
+
+HUNSPELL_DIR = '/usr/share/hunspell'
+
+# Spell check dictionary location: http://wiki.host.tld/index.php/Spellchecker_Dict
+CUSTOM_DICT_PAGE = "Spellchecker_Dict"
+
+# the words of the custom dictionary page, None: not fetched yet
+_customWords = None
+
+# dictionary name -> Session (None if it cannot be loaded)
+_sessions = {}
+
+# how many word results a Session keeps by default
+WORD_CACHE_SIZE = 100000
+
+# blocks whose content is not prose, possibly spanning several lines
+BLOCKSTART = re.compile(
+    r'<(uml|code|pre|source|syntaxhighlight|math|nowiki)\b[^>]*?(/?)>',
+    re.I)
+
+# table start, end and row separator lines
+TABLELINE = re.compile(r'^\s*(\{\||\|\}|\|-)')
+
+# markup within a line
+SKIP = re.compile(r"""
+      \[\[\s*(?:File|Image)\s*:.*?\]\]    # file links
+    | (?:https?|ftp)://[^\s\]|<>]+         # URLs
+    | \{\{.*?\}\}                          # templates
+    | <[^<>]*>                              # HTML tags
+    | [\w-]+\s*=\s*"[^"]*"                  # attributes
+    | ^\s*[|!]                              # table cells ...
+    | \|\||!!                               # ... in one line
+    """, re.I | re.X)
+
+
+def parseCustomWords(text):
+    """the words of a custom dictionary page, one per (list) line"""
+    words = []
+    for l in text.split('\n'):
+        l = l.strip("\r *-+")
+        if l.isalpha():
+            words.append(l)
+    return words
+
+
+def fetchCustomWords(page=CUSTOM_DICT_PAGE):
+    """Download the custom dictionary page from the wiki (into a
+    private directory, so concurrent builds do not get in each
+    other's way) and return its words; [] if that is not possible.
+    """
+    print "Updating custom spell check dictionary using %r" % page
+    tmpdir = tempfile.mkdtemp(prefix='spellcheck')
+    try:
+        wiki.download(page, tmpdir, None, False)
+        with open(os.path.join(tmpdir, page.replace(' ', '_') + '.md'),
+                  'r') as f:
+            return parseCustomWords(f.read())
+    except Exception as e:
+        print "No custom spell check dictionary: ", e
+        return []
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def setup(page=CUSTOM_DICT_PAGE):
+    """Fetch the custom dictionary for this build."""
+    global _customWords
+    _customWords = fetchCustomWords(page)
+
+
+class Session(object):
+    """A hunspell dictionary with the custom words added,
+    and the results for the last maxwords words checked."""
+
+    def __init__(self, name, hobj, customWords, maxwords=WORD_CACHE_SIZE):
+        self.hobj = hobj
+        self.maxwords = maxwords
+        self.words = OrderedDict()
+
+        # everything the marked up text depends on
+        self.digest = filecache.key(name,
+                                    filecache.filehash(
+                                        __file__.replace('.pyc', '.py')),
+                                    *customWords)
+
+    def spell(self, word):
+        correct = self.words.pop(word, None)
+        if correct is None:
+            correct = self.hobj.spell(word)
+            if len(self.words) >= self.maxwords:
+                self.words.popitem(last=False)
+        self.words[word] = correct
+        return correct
+
+    def markText(self, text, mistakes):
+        """Mark misspelled words in prose text as ??word??."""
+        out_words = list()
+        for w in text.split(" "):
+            # generate a version of the word that does not contain any non-alpha characters
+            w_striped = w.strip(".:;,!?'_-")
+            if w_striped.isalpha():
+                if not self.spell(w_striped):
+                    mistakes.append(w_striped)
+                    # mark mistake! we need to stick to simple ASCII chars, things like <strike> could break the latex document if they occur, e.g., in headings
+                    w = w.replace(w_striped, "??%s??" % w_striped)
+            out_words.append(w)
+        return " ".join(out_words)
+
+    def markLine(self, line, block=None):
+        """Mark the misspelled words in one line of wikitext.
+        block is the non-prose block (e.g. 'uml') that is open at
+        the start of the line, or None.
+
+        Returns the marked line, the block open at its end,
+        and the misspelled words.
+        """
+        if block is None and TABLELINE.match(line):
+            return line, None, []
+
+        out = []
+        mistakes = []
+        pos = 0
+        while pos < len(line):
+            if block:
+                m = re.compile(r'</%s\s*>' % block, re.I).search(line, pos)
+                end = m.end() if m else len(line)
+                out.append(line[pos:end])
+                pos = end
+                if m:
+                    block = None
+                continue
+
+            m = BLOCKSTART.search(line, pos)
+            end = m.start() if m else len(line)
+            # prose, except for inline markup
+            for s in SKIP.finditer(line, pos, end):
+                out.append(self.markText(line[pos:s.start()], mistakes))
+                out.append(s.group(0))
+                pos = s.end()
+            out.append(self.markText(line[pos:end], mistakes))
+            pos = end
+            if m:
+                out.append(m.group(0))
+                pos = m.end()
+                if not m.group(2):
+                    block = m.group(1).lower()
+
+        return "".join(out), block, mistakes
+
+    def checkFile(self, filename, cache=None, key=None):
+        """Mark the misspelled words in a wikitext file in place.
+        With a FileCache, the results for the lines of the file are
+        kept under key, and lines that are unchanged since the last
+        check of the page are not checked again.
+        """
+        print "Doing spell check on %r" % filename
+        with open(filename, 'r') as f:
+            lines = [l.strip("\n") for l in f.readlines()]
+
+        key = filecache.key(key or filename, self.digest)
+        before = (cache.load(key) if cache is not None else None) or {}
+        after = {}
+
+        out_lines = list()
+        block = None
+        checked = 0
+        for line in lines:
+            result = before.get((block, line))
+            if result is None:
+                result = self.markLine(line, block)
+                checked += 1
+            after[(block, line)] = result
+            marked, block, mistakes = result
+            for w in mistakes:
+                print "Spelling mistake: %r" % w
+            out_lines.append(marked)
+        print "Spell checked %d of %d lines" % (checked, len(lines))
+
+        if cache is not None:
+            cache.store(key, after)
+
+        # write back
+        with open(filename, 'w') as f:
+            f.write("\n".join(out_lines))
+
+
+def getSession(spellCheckDict, maxwords=WORD_CACHE_SIZE):
+    """The Session for dictionary spellCheckDict;
+    None if the dictionary is not installed.
+    """
+    if spellCheckDict in _sessions:
+        return _sessions[spellCheckDict]
+
+    if _customWords is None:
+        setup()
+
+    try:
+        hobj = hunspell.HunSpell(
+            os.path.join(HUNSPELL_DIR, '%s.dic' % spellCheckDict),
+            os.path.join(HUNSPELL_DIR, '%s.aff' % spellCheckDict))
+    except:
+        print "Error: Dictionary %r not found." % spellCheckDict
+        hobj = None
+
+    session = None
+    if hobj is not None:
+        for w in _customWords:
+            if not hobj.spell(w):
+                # word is not in dict, lets add it
+                hobj.add(w)
+                print "added %r" % w
+        session = Session(spellCheckDict, hobj, _customWords, maxwords)
+
+    _sessions[spellCheckDict] = session
+    return session
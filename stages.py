@@ -0,0 +1,91 @@
+"""Make-style stages for building a document.
+
+Each stage of processDocument declares its inputs as a dictionary of
+named hashes (file contents via a Manifest, settings, tool versions,
+the keys of the stages it depends on) and reports the files it
+produced. A stage is skipped if its inputs are the same as in the last
+build and its outputs are still there, unchanged; its result (e.g. the
+list of bibtex keys) is then taken from the last build.
+
+The state of all stages of a document is a dictionary, which takes the
+place of the document's fingerprint.
+"""
+
+import os
+import time
+
+import filecache
+import fingerprint
+
+
+class Pipeline(object):
+
+    def __init__(self, manifest, previous=None):
+        self.manifest = manifest
+        self.previous = previous if isinstance(previous, dict) else {}
+        # stage name -> {'inputs': ..., 'outputs': ..., 'result': ...,
+        #                'seconds': ...}
+        self.state = {}
+        self.ran = []
+        self.skipped = []
+        # (stage, names of the changed inputs) of the stages run
+        self.changes = []
+
+    def _last(self, name):
+        last = self.previous.get(name)
+        if isinstance(last, dict) and 'inputs' in last:
+            return last
+        return None
+
+    def intact(self, outputs):
+        """do all the files in outputs (path -> hash) still exist,
+        with the same content?"""
+        for path, h in outputs.items():
+            if not os.path.isfile(path) or self.manifest.filehash(path) != h:
+                return False
+        return True
+
+    def run(self, name, inputs, action):
+        """Run stage name, unless it is up to date.
+        action() has to return the stage's result and the list of the
+        files it produced. Returns the result of the stage.
+        """
+        last = self._last(name)
+        if last is not None:
+            changed = fingerprint.changed(last['inputs'], inputs)
+            if not changed and self.intact(last['outputs']):
+                print "stage %s: up to date" % name
+                self.state[name] = last
+                self.skipped.append(name)
+                return last['result']
+            changed = changed or ['outputs']
+            print "stage %s: changed inputs: %s" % (name, ', '.join(changed))
+            self.changes.append((name, changed))
+        else:
+            print "stage %s: no previous build" % name
+            self.changes.append((name, ['all']))
+
+        start = time.time()
+        result, outputs = action()
+        self.state[name] = {
+            'inputs': inputs,
+            'seconds': time.time() - start,
+            'outputs': dict((f, self.manifest.filehash(f))
+                            for f in outputs if os.path.isfile(f)),
+            'result': result,
+            }
+        self.ran.append(name)
+        return result
+
+    def forget(self, name):
+        """do not remember stage name, so that it runs again next time"""
+        self.state.pop(name, None)
+
+    def key(self, name):
+        """a hash over what stage name has produced, for the
+        inputs of the stages depending on it"""
+        state = self.state.get(name)
+        if state is None:
+            return None
+        return filecache.key(repr(sorted(state['outputs'].items())),
+                             repr(state['result']))
@@ -0,0 +1,38 @@
+"""Tests for latexpost.py; run with python -m unittest test_latexpost"""
+
+import unittest
+
+from citations import CitationResolver
+from latexpost import LatexPostProcessor
+
+
+class LatexPostProcessorTest(unittest.TestCase):
+
+    def process(self, doc):
+        post = LatexPostProcessor(CitationResolver([]), 0.8)
+        return post.process(doc, 'chapter.tex')
+
+    def test_unlabeled_figure_before_table(self):
+        doc = ('\\includegraphics{arch.png}\n'
+               '\\caption{Overall architecture}\n'
+               'text\n'
+               '\\begin{longtable}[c]{@{}ll@{}}\n'
+               '\\caption{Requirements\\#tab:req\\#p\\{30\\%\\}p\\{70\\%\\}}'
+               '\\tabularnewline\n')
+        out = self.process(doc)
+        self.assertIn('\\includegraphics{arch.png}\n'
+                      '\\caption{Overall architecture}', out)
+        self.assertIn('\\begin{longtable}[c]{p{.30\\textwidth}p{.70\\textwidth}}'
+                      ' \\caption{Requirements}\\label{tab:req}'
+                      '\\tabularnewline', out)
+
+    def test_labeled_figure(self):
+        out = self.process('\\includegraphics{arch.png}\n'
+                           '\\caption{Architecture\\#Fig:Arch\\#0.5}')
+        self.assertEqual(out,
+                         '\\includegraphics[width=0.5\\textwidth]{arch.png}'
+                         '\\caption{Architecture}\\label{fig:arch}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""Render PlantUML diagrams in batches.
+
+Starting the JVM and initialising PlantUML takes about a second, so
+instead of one java process per diagram, all diagrams of a build are
+collected first and handed to a single PlantUML run. PlantUML writes
+each output next to its .uml source file, under the same base name.
+
+Renderings can be cached by diagram content: the cache key is a hash
+of the normalized UML source, the PlantUML jar and the output format,
+so a diagram is only rendered again if one of these has changed -
+not because its position on the page (and hence its file name) did.
+"""
+
+import os
+import re
+import subprocess
+
+import filecache
+
+
+PLANTUML_JAR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'plantuml.jar')
+
+# keep the command line of a single java call at a reasonable length
+BATCH_SIZE = 200
+
+
+def outputFile(umlfile, fmt='eps'):
+    return os.path.splitext(umlfile)[0] + '.' + fmt
+
+
+def normalize(source):
+    """Drop differences in line endings and trailing or
+    surrounding whitespace that do not change the diagram."""
+    lines = [l.rstrip() for l in source.replace('\r\n', '\n').split('\n')]
+    return '\n'.join(lines).strip()
+
+
+def cacheKey(umlfile, fmt, jar):
+    with open(umlfile, 'r') as f:
+        source = f.read()
+    return filecache.key(normalize(source), filecache.filehash(jar), fmt)
+
+
+def render(umlfiles, fmt='eps', jar=PLANTUML_JAR, cache=None):
+    """Render all the given .uml files with one PlantUML process
+    (per BATCH_SIZE files). If a FileCache is given, diagrams found
+    in it are not rendered again, and new renderings are added to it.
+
+    Returns a dictionary mapping each .uml file to None on success,
+    or to an error message.
+    """
+
+    umlfiles = [os.path.abspath(f) for f in umlfiles]
+    errors = dict((f, None) for f in umlfiles)
+
+    keys = {}
+    if cache is not None:
+        keys = dict((f, cacheKey(f, fmt, jar)) for f in umlfiles)
+        umlfiles = [f for f in umlfiles
+                    if not cache.get(keys[f], outputFile(f, fmt))]
+        print "UML cache hits: %d of %d" % (len(errors) - len(umlfiles),
+                                            len(errors))
+
+    if not umlfiles:
+        return errors
+
+    # remove old renderings, so that a missing output means failure
+    for f in umlfiles:
+        if os.path.exists(outputFile(f, fmt)):
+            os.unlink(outputFile(f, fmt))
+
+    for i in range(0, len(umlfiles), BATCH_SIZE):
+        batch = umlfiles[i:i + BATCH_SIZE]
+        print "rendering %d UML diagrams" % len(batch)
+        p = subprocess.Popen(['java',
+                              '-jar',
+                              jar,
+                              '-t' + fmt] + batch,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        output, _ = p.communicate()
+
+        # PlantUML reports syntax errors as "Error line N in file: X"
+        for m in re.finditer(r'Error line (\d+) in file: (.*)', output):
+            f = os.path.abspath(m.group(2).strip())
+            if f in errors:
+                errors[f] = "syntax error in line " + m.group(1)
+
+        if p.returncode and not any(errors[f] for f in batch):
+            print "plantuml returned ", p.returncode, output
+
+    for f in umlfiles:
+        if errors[f] is None and not os.path.exists(outputFile(f, fmt)):
+            errors[f] = "no output produced"
+        if errors[f]:
+            print "*** WARNING: UML diagram %s: %s ***" % (f, errors[f])
+        elif cache is not None:
+            cache.put(keys[f], outputFile(f, fmt))
+
+    if cache is not None:
+        cache.evict()
+
+    return errors
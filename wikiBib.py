@@ -1,62 +1,83 @@
 """Convert wiki bibformat as invented by Jose Bonnet into bibtex
+
+A page is read line by line: a heading starts a new entry (its text
+is the key), and list items of the form "* field: value" add fields to
+it. Entries whose (lower-cased) key has already been written for the
+document are skipped. With a FileCache, the entries of a page are
+cached by the page's content.
 """
 
 import sys
 import os
 import collections
 import re
+import hashlib
+
+import filecache
 
-def readwiki(filename):
-    entries = []
-    with open(filename, 'r') as fp:
-        lines = fp.readlines()
 
+# == key ==
+ENTRYSTART = re.compile(r'\s*=+(.*?)=+')
+
+# * field: value
+FIELD = re.compile(r'\s*\*\s*(.*?)\s*:\s*(.*)')
+
+
+def iterentries(lines):
+    """the entries in an iterable of wiki lines, one at a time"""
     # in d, we store what we know about the current entry
     d = {}
 
     for l in lines:
         # do we start a new entry?
-        try:
-            m = re.match('\s*=+(.*?)=+', l)
-            key = m.group(1)
-
-            # print "found key", key
-
-            # if no exception up to hear, we have found a new entry strat
+        m = ENTRYSTART.match(l)
+        if m:
             # store the old entry:
             if d:
-                entries.append(d)
+                yield d
 
             # start remembering the new entry:
-            d = {'key': key.strip().lower(),
+            d = {'key': m.group(1).strip().lower(),
                  'type': 'misc'}
-
-            # print "dict: ", d
             continue
-        except:
-            pass
 
-        # print l
-        m = re.match('\s*\*\s*(.*?)\s*:\s*(.*)', l)
-        try:
-            key = m.group(1)
-            val = m.group(2)
-            d[key.strip()]  = val.strip()
-        except:
-            pass
+        m = FIELD.match(l)
+        if m and d:
+            d[m.group(1).strip()] = m.group(2).strip()
+
+    if d:
+        yield d
+
 
-    entries.append(d)
+def readwiki(filename):
+    with open(filename, 'r') as fp:
+        return list(iterentries(fp))
 
-    return entries
 
+def pagekey(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for l in fp:
+            h.update(l)
+    return filecache.key(h.hexdigest(),
+                         filecache.filehash(__file__.replace('.pyc', '.py')))
 
-def writebib(entries, outfile):
+
+def writebib(entries, outfile, seen=None):
+    """append the entries to outfile, except for those whose key
+    is in the set seen (which is updated); returns the keys written"""
 
     keys = []
+    if seen is None:
+        seen = set()
 
     with open(outfile, 'a') as fp:
         for e in entries:
             key = e['key']
+            if key.lower() in seen:
+                print "skipping duplicate bibliography entry: ", key
+                continue
+            seen.add(key.lower())
             keys.append(key)
             fp.write("@{}{{{},\n".format(e['type'],
                                         key))
@@ -67,10 +88,20 @@ def writebib(entries, outfile):
     return keys
 
 
-def wikibib(infile, outfile):
-    entries = readwiki(infile)
-    return writebib(entries, outfile)
+def wikibib(infile, outfile, seen=None, cache=None):
+    """convert the Wikibib page infile, appending to outfile;
+    seen and the returned keys as for writebib"""
+    if cache is None:
+        with open(infile, 'r') as fp:
+            return writebib(iterentries(fp), outfile, seen)
+
+    key = pagekey(infile)
+    entries = cache.load(key)
+    if entries is None:
+        entries = readwiki(infile)
+        cache.store(key, entries)
+    return writebib(entries, outfile, seen)
 
 
 if __name__ == '__main__':
-    wikibib(sys.argv[1], 'bla.bib')
+    wikibib(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'bla.bib')
@@ -16,13 +16,28 @@
 import argparse
 import os
 import re
-import subprocess
 from pprint import pprint as pp
 import mwclient  # pip install mwclient
+from pagestore import PageStore
+from downloader import Downloader
+from assetstore import AssetStore, linkfile
 
 # global pointer to our active wiki
 SITE = None
 
+# global pointer to the local page store (None: always fetch everything)
+STORE = None
+
+# global pointer to the download engine for embedded files
+DOWNLOADER = None
+
+# global pointer to the shared store for embedded files (None: no sharing)
+ASSETS = None
+
+# how many titles the API accepts in a single query
+# (500 for accounts with the apihighlimits right)
+API_TITLE_LIMIT = 50
+
 
 def setup_connection(host, user=None, password=None):
     """
@@ -34,55 +49,242 @@ def setup_connection(host, user=None, password=None):
         SITE.login(user, password)
 
 
-def no_archived_elements(img_list):
+def setup_pagestore(directory, state=None):
+    """
+    Keep downloaded pages in a local store, so that only
+    pages with a new revision need to be fetched again.
+    The revisions are kept in the BuildState state, if given.
+    """
+    global STORE
+    STORE = PageStore(directory, state)
+
+
+def setup_assetstore(directory):
     """
-    Removes old revisions from image list.
-    Old versions can be identified by having
-    'archive' as part of their url.
-    Not nice, but the mwclinet APi does not
-    provide a build-in solution for revision management.
+    Keep embedded files in a content-addressed store shared
+    by all documents, and only link them into the output directories.
     """
-    return [i for i in img_list if 'archive' not in i.imageinfo['url']]
+    global ASSETS
+    ASSETS = AssetStore(directory)
 
 
-def fetch_wiki_page(site, page, out=None, embedded_elements=True):
+def setup_downloader(concurrency=8, retries=3, statefile=None,
+                     cachedir=None):
     """
+    Configure the engine used to download embedded files.
+    """
+    global DOWNLOADER
+    DOWNLOADER = Downloader(concurrency=concurrency,
+                            retries=retries,
+                            statefile=statefile,
+                            cachedir=cachedir)
+
+
+def get_downloader():
+    """
+    Return the download engine, with default settings if
+    setup_downloader has not been called.
+    """
+    global DOWNLOADER
+    if DOWNLOADER is None:
+        DOWNLOADER = Downloader()
+    return DOWNLOADER
+
+
+def save_pagestore():
+    """
+    Write the revisions (and file ETags) fetched so far back to disk.
+    """
+    global STORE
+    if STORE is not None:
+        STORE.save()
+    if DOWNLOADER is not None:
+        DOWNLOADER.save()
+
+
+def chunks(items, n):
+    """
+    Split items into lists of at most n elements.
+    """
+    return [items[i:i + n] for i in range(0, len(items), n)]
+
+
+def query_titles(site, titles, **params):
+    """
+    Run an API query for many titles at once. Titles are sent
+    in batches of API_TITLE_LIMIT, continuations are followed and
+    list-valued properties (revisions, images, ...) are merged.
+    Returns a tuple (pages, normalized): pages maps the wiki's
+    title to the page dict, normalized maps requested names to
+    the wiki's title.
+    """
+    pages = {}
+    normalized = {}
+    for batch in chunks(titles, API_TITLE_LIMIT):
+        query = dict(params)
+        query['titles'] = '|'.join(batch)
+        query['continue'] = ''
+        while True:
+            res = site.api('query', **query)
+            q = res.get('query', {})
+            for n in q.get('normalized', []):
+                normalized[n['from']] = n['to']
+            for p in q.get('pages', {}).values():
+                merged = pages.setdefault(p['title'], {})
+                for k, v in p.items():
+                    if isinstance(v, list):
+                        merged.setdefault(k, []).extend(v)
+                    else:
+                        merged[k] = v
+            if 'continue' not in res:
+                break
+            query.update(res['continue'])
+    return pages, normalized
+
+
+def fetch_wiki_pages(site, targets, embedded_elements=True, store=None,
+                     assets=None):
+    """
+    Fetch the text of many pages (and their embedded elements)
+    with as few API round-trips as possible.
+
     Arguments:
     - site : mwclient site object
-    - page : either mwclient page object or pagename as string
-    """
-    if isinstance(page, basestring) or isinstance(page, str):
-        # if we get a pagename: fetch the page object
-        page = site.Pages[page]
-    if not page.exists:
-        raise Exception("Page not found: %s" % page.name)
-    out = "out" if out is None else out
-    ensure_dir(out)
-
-    print "Fetching page: %s" % page.name
-    # fetch page content as markdown
-    pagefile = re.sub(' ', '_', page.name)
-    with open("%s%s.md" % (out, pagefile), 'w') as f:
-        f.write(page.text().encode('utf8'))
-    print "Stored page content in %s.md" % page.name
-
-    # fetch all images used in page
+    - targets : list of (pagename, output directory) tuples
+    - store : optional PageStore; only pages whose revision differs
+      from the stored one are fetched, all others come from the store
+    - assets : optional AssetStore; embedded files are downloaded into
+      it once and linked into the output directories
+
+    Returns the list of pagenames which were fetched successfully.
+    """
+    names = []
+    for name, out in targets:
+        if name not in names:
+            names.append(name)
+
+    print "Fetching %d pages" % len(names)
+    texts = {}
+    if store is None:
+        pages, normalized = query_titles(site, names,
+                                         prop='revisions|info|images',
+                                         rvprop='ids|content',
+                                         imlimit='max')
+        for title, page in pages.items():
+            if page.get('revisions'):
+                texts[title] = page['revisions'][0]['*'].encode('utf8')
+    else:
+        # first only ask for the current revision IDs ...
+        pages, normalized = query_titles(site, names,
+                                         prop='info|images',
+                                         imlimit='max')
+        stale = sorted(title for (title, page) in pages.items()
+                       if 'missing' not in page and 'lastrevid' in page and
+                       store.lookup(title, page['lastrevid']) is None)
+        print "Pages with new revisions: %d of %d" % (len(stale), len(pages))
+
+        # ... and fetch the content of the changed ones only
+        if stale:
+            revisions, _ = query_titles(site, stale,
+                                        prop='revisions',
+                                        rvprop='ids|content')
+            for title, page in revisions.items():
+                if page.get('revisions'):
+                    rev = page['revisions'][0]
+                    # (the page may have been edited since the first
+                    # query: then this is a newer revision, use it)
+                    texts[title] = rev['*'].encode('utf8')
+                    store.put(title, rev['revid'], texts[title])
+
+        for title, page in pages.items():
+            if title not in texts and 'lastrevid' in page and \
+               store.lookup(title, page['lastrevid']) is not None:
+                texts[title] = store.get(title)
+
+    fetched = []
+    images = {}
+    for name, out in targets:
+        title = normalized.get(name, name)
+        page = pages.get(title)
+        if page is None or 'missing' in page or title not in texts:
+            print "*** WARNING: Page not found: %s ***" % name
+            continue
+        ensure_dir(out)
+        # fetch page content as markdown
+        pagefile = re.sub(' ', '_', title)
+        with open("%s%s.md" % (out, pagefile), 'w') as f:
+            f.write(texts[title])
+        print "Stored page content in %s.md" % title
+        if name not in fetched:
+            fetched.append(name)
+        if embedded_elements:
+            for img in page.get('images', []):
+                images.setdefault(img['title'], set()).add(out)
+
+    # fetch all images used in the pages
     # TODO: Filter? This will download all linked files (e.g. PDFs)
-    if embedded_elements:
-        print "Fetching page's embedded elements"
-        download_ps = []
-        for img in no_archived_elements(page.images()):
-            p = subprocess.Popen(
-                ["wget", "-xNq",
-                 "-O%s%s" % (out, img.name.replace("File:", "")),
-                 img.imageinfo['url']
-                 ])
-            download_ps.append(p)
-            print "Downloading: %s" % img.name
+    if images:
+        print "Fetching embedded elements"
+        infos, _ = query_titles(site, sorted(images),
+                                prop='imageinfo',
+                                iiprop='url|sha1|size')
+        downloader = get_downloader()
+        jobs = []
+        staged = {}     # download destination -> sha1, for the asset store
+        pending = set() # sha1s being downloaded (titles may share content)
+        links = []      # (sha1, destination) to link from the asset store
+        copies = []     # (cache file, destination) to link from the cache
+        for title, info in sorted(infos.items()):
+            imageinfo = info.get('imageinfo')
+            if not imageinfo or 'archive' in imageinfo[0]['url']:
+                continue
+            url = imageinfo[0]['url']
+            sha1 = imageinfo[0].get('sha1')
+            dests = ["%s%s" % (out, title.replace("File:", ""))
+                     for out in sorted(images.get(title, []))]
+
+            if assets is None or not sha1:
+                # kept in the downloader's cache between builds, so
+                # that it is only transferred again if it has changed
+                cached = downloader.cachefile(url)
+                if cached is None:
+                    jobs.extend((url, dest) for dest in dests)
+                else:
+                    if cached not in pending:
+                        pending.add(cached)
+                        jobs.append((url, cached))
+                    copies.extend((cached, dest) for dest in dests)
+                print "Downloading: %s" % title
+                continue
+
+            # content-addressed: download once, link everywhere
+            if not assets.has(sha1) and sha1 not in pending:
+                pending.add(sha1)
+                dest = assets.staging(sha1)
+                staged[dest] = sha1
+                jobs.append((url, dest))
+                print "Downloading: %s" % title
+            links.extend((sha1, dest) for dest in dests)
+
         print "Waiting for all downloads to finish..."
-        ecodes = [p.wait() for p in download_ps]
-        if 1 in ecodes:
-            print "*** WARNING: File download failed. ***"
+        for url, dest, status, error in downloader.fetch(jobs):
+            if error:
+                print "*** WARNING: File download failed: %s (%s) ***" % (
+                    url, error)
+            elif dest in staged:
+                if not assets.add(dest, staged[dest]):
+                    print "*** WARNING: Checksum mismatch: %s ***" % url
+            else:
+                print "%s: %s" % (status, dest)
+
+        for sha1, dest in links:
+            if assets.has(sha1):
+                assets.link(sha1, dest)
+        for cached, dest in copies:
+            if os.path.isfile(cached):
+                linkfile(cached, dest)
+
+    return fetched
 
 
 def fetch_wiki_category(site, catname, out=None, embedded_elements=True):
@@ -94,8 +296,11 @@ def fetch_wiki_category(site, catname, out=None, embedded_elements=True):
     # if output folder not given, use catname
     out = ("%s/" % catname) if out is None else out
     # fetch all pages found in category
-    for page in site.Categories[catname]:
-        fetch_wiki_page(site, page, out, embedded_elements=embedded_elements)
+    names = [page.name for page in site.Categories[catname]]
+    fetch_wiki_pages(site, [(n, out) for n in names],
+                     embedded_elements=embedded_elements,
+                     store=STORE,
+                     assets=ASSETS)
 
 
 def ensure_dir(directory):
@@ -116,12 +321,62 @@ def download(target,
     if category:
         fetch_wiki_category(SITE, target, output, embedded_elements=embedded_elements)
     else:
-        fetch_wiki_page(SITE, target, output, embedded_elements=embedded_elements)
+        if not fetch_wiki_pages(SITE, [(target, output)],
+                                embedded_elements=embedded_elements,
+                                store=STORE,
+                                assets=ASSETS):
+            raise Exception("Page not found: %s" % target)
 
 
-def upload_document(doc, excp):
+def download_pages(targets, embedded_elements=True):
+    """
+    Download many pages at once.
+    targets is a list of (pagename, output directory) tuples;
+    returns the list of pagenames that could be fetched.
+    """
+    global SITE
+    if SITE is None:
+        raise Exception("Wiki connection was not initialized.")
+    targets = [(t, o if o.endswith('/') else o + '/')
+               for (t, o) in targets]
+    return fetch_wiki_pages(SITE, targets,
+                            embedded_elements=embedded_elements,
+                            store=STORE,
+                            assets=ASSETS)
+
+
+def recent_changes(since):
+    """
+    Titles of all pages (and files) that have been changed
+    on the wiki since the given timestamp.
+    """
+    global SITE
+    if SITE is None:
+        raise Exception("Wiki connection was not initialized.")
+
+    query = {'list': 'recentchanges',
+             'rcstart': since,
+             'rcdir': 'newer',
+             'rcprop': 'title',
+             'rclimit': 'max',
+             'continue': ''}
+    titles = set()
+    while True:
+        res = SITE.api('query', **query)
+        titles.update(rc['title']
+                      for rc in res.get('query', {}).get('recentchanges', []))
+        if 'continue' not in res:
+            break
+        query.update(res['continue'])
+    return titles
+
+
+def upload_document(doc, excp, report=None, archivefile=None):
     """upload both build progress information
-    as well as a potneitally generated PDF """
+    as well as a potneitally generated PDF.
+    report is an optional list of (name, value) build statistics,
+    archivefile the archive of the intermediate files (default:
+    doc/doc-latex.tgz)."""
     global SITE
 
     # deal with any possible exceptions
@@ -145,9 +400,9 @@ def upload_document(doc, excp):
         print "no pdf to upload"
 
     # any tar file to upload?
-    tarfile = os.path.join(doc, doc+'-latex.tgz')
+    tarfile = archivefile or os.path.join(doc, doc+'-latex.tgz')
     if os.path.isfile(tarfile):
-        uploadName = doc+'-latex.tgz'
+        uploadName = os.path.basename(tarfile)
         print "tar file exsists, upload: ", tarfile, uploadName
         res = SITE.upload(open(tarfile),
                           uploadName,
@@ -187,6 +442,11 @@ def upload_document(doc, excp):
         text += "\n</nowiki>\n"
     else:
         text += "\n== No errors reported! ==\n"
+
+    if report:
+        text += "\n== Build statistics ==\n"
+        for name, value in report:
+            text += "* {}: {}\n".format(name, value)
     # done 
 
 
@@ -211,6 +471,10 @@ def setup_cli_parser():
                         help="Fetch entire category instead of single page")
     parser.add_argument("--out", dest="output", default="out/",
                         help="Output directory (default is 'out' or name of category)")
+    parser.add_argument("--store", dest="store", default=None,
+                        help="Directory of a local page store; only pages with new revisions are fetched")
+    parser.add_argument("--assets", dest="assets", default=None,
+                        help="Directory of a shared, content-addressed store for embedded files")
     parser.add_argument("target",
                         help="Page name or category name to fetch")
     return parser
@@ -219,4 +483,9 @@ if __name__ == '__main__':
     parser = setup_cli_parser()
     args = parser.parse_args()
     setup_connection(host=args.host, user=args.user, password=args.password)
+    if args.store:
+        setup_pagestore(args.store)
+    if args.assets:
+        setup_assetstore(args.assets)
     download(**vars(args))
+    save_pagestore()